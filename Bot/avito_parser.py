@@ -1,16 +1,25 @@
-from asyncio import sleep
+from asyncio import CancelledError, ensure_future, gather, shield, sleep, Task
+from collections import OrderedDict
+from functools import partial
+from hashlib import sha1
 import logging
 import os
-from random import randint
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 from aiogram import Bot
+from aiogram.utils.exceptions import ChatNotFound, Unauthorized
 from bs4 import BeautifulSoup
-from httpx import StreamError
+from httpx import codes, Response, StreamError
 
 import db_aps
+import delivery
+import page_parser
 import phrases
+import scheduler
+import subscriptions
 import utils
+import workers
 
 
 avito_parser_logger = logging.getLogger('avito_parser_logger')
@@ -27,85 +36,287 @@ SEARCH_HEADERS = {
     'Origin': 'https://www.avito.ru',
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:79.0) Gecko/20100101 Firefox/79.0',
 }
+# 'json' (embedded state with lxml fallback), 'lxml' or 'bs4'. Publication date of
+# 'json' products is formatted like '13.09.2020 15:26', of others like '12 октября 16:18'
+SEARCH_PAGE_PARSER = os.getenv('SEARCH_PAGE_PARSER', 'json')
+# Take product images from search page thumbnails ('search') and download product page
+# only if there is no thumbnail, or always take them from product page ('product_page')
+IMG_SOURCE = os.getenv('IMG_SOURCE', 'search')
 DEFAULT_IMG = 'https://upload.wikimedia.org/wikipedia/commons/8/84/Avito_logo1.png'
+SEARCH_PAGES_CONCURRENCY = int(os.getenv('SEARCH_PAGES_CONCURRENCY', 2))
+# Next pages are optional, so they aren't retried much
+SEARCH_PAGE_ATTEMPTS = int(os.getenv('SEARCH_PAGE_ATTEMPTS', 3))
+VALIDATOR_HEADERS = {  # response header: conditional request header
+    'etag': 'If-None-Match',
+    'last-modified': 'If-Modified-Since',
+}
+# Blocked bot, deactivated or missing chat, retries of such updates will fail too
+PERMANENT_DELIVERY_ERRORS = (Unauthorized, ChatNotFound)
+
+IMG_URLS_CACHE_SIZE = int(os.getenv('IMG_URLS_CACHE_SIZE', 1000))
+
+_img_urls: 'OrderedDict[str, str]' = OrderedDict()
+_img_url_tasks: Dict[str, Task] = dict()
 
 
-async def start_parser(bot: Bot, sleep_time: int = 300):
+async def start_parser(bot: Bot, sleep_time: int = 3600):
     """Start parser avito parser.
 
-    Parser gets search queries from db,
-    checks them for updates and send updates to users.
+    Parser schedules launched searches, then starts and stops searches
+    by events from bot handlers, scheduler checks them for updates and
+    send updates to users. Every distinct search url is checked once per
+    its cycle, no matter how many users are subscribed to it.
+    Searches are reconciled with db every sleep_time sec in case some events were lost.
+    Every parser worker schedules only its own share of searches (see workers).
     """
+    await workers.update_live_workers()
+    bot.loop.create_task(workers.run_heartbeat(rebalance_searches))
     bot.loop.create_task(utils.run_proxi_updater())
-    launched_searches = db_aps.get_launched_searches()
-    if launched_searches:
-        for user_id, user_searches in launched_searches.items():
-            for search in user_searches:
-                bot.loop.create_task(check_user_search(user_id, search, bot))
+    bot.loop.create_task(scheduler.run_scheduler(
+        partial(check_search, bot=bot), store_check=db_aps.store_search_check))
+    bot.loop.create_task(run_search_events_listener())
+
+    launched_searches = await db_aps.get_launched_searches()
+    for search_url, search_subscribers in launched_searches.items():
+        for user_id in search_subscribers:
+            subscriptions.add_subscription(user_id, search_url)
+    await rebalance_searches()
 
     while True:
         avito_parser_logger.debug('Starting new parser cycle stage')
-        all_searches = db_aps.collect_searches()
-        launched_searches = db_aps.get_launched_searches()
-        if not launched_searches:
-            launched_searches = dict()
-        for user_id, user_searches in all_searches.items():
-            user_launched_searches = launched_searches.get(user_id, [])
-            for user_search in user_searches:
-                if user_search in user_launched_searches:
-                    continue
-                db_aps.add_launched_search(user_id, user_search)
-                print(dir(bot.loop.create_task(check_user_search(user_id, user_search, bot))))
-            await sleep(0)
+        await sync_subscriptions()
         avito_parser_logger.debug(
-            f'All new searches launched, parser start sleeping for {sleep_time}')
+            f'Searches reconciled, parser start sleeping for {sleep_time}')
         await sleep(sleep_time)
 
 
-async def check_user_search(user_id: str, search_url: str, bot: Bot):
-    """Check user's search and notify him about new and updated products."""
+async def run_search_events_listener(reconnect_delay: int = 5):
+    """Start and stop searches on events published by bot handlers."""
     while True:
-        launched_searches = db_aps.get_user_launched_searches(user_id)
-        if not launched_searches:
-            return
-        if search_url not in launched_searches:
-            return
         try:
-            await parse_and_handle_avito_products_update(search_url, user_id, bot)
-        except StreamError:
-            avito_parser_logger.error(f'Got StreamError for {search_url}')
+            async for event in db_aps.listen_search_events():
+                await handle_search_event(event)
         except Exception:
-            await utils.handle_exception('avito_parser_logger')
-        await sleep(randint(1200, 2400))
-
+            avito_parser_logger.exception('Search events listener failed')
+        await sleep(reconnect_delay)
+        try:
+            # Events published while listener was disconnected are lost
+            await sync_subscriptions()
+        except Exception:
+            avito_parser_logger.exception('Failed to sync subscriptions after reconnect')
+
+
+async def handle_search_event(event: dict):
+    """Update subscriptions registry and schedule by search event."""
+    user_id, search_url = event['user_id'], event['search_url']
+    if event['event'] == db_aps.SEARCH_STARTED:
+        subscriptions.add_subscription(user_id, search_url)
+        if workers.owns_search(search_url):
+            scheduler.reschedule_search(search_url)
+        await db_aps.add_launched_search(user_id, search_url)
+        avito_parser_logger.debug(f'Search of user {user_id} started: {search_url}')
+    elif event['event'] == db_aps.SEARCH_STOPPED:
+        if subscriptions.remove_subscription(user_id, search_url):
+            scheduler.unschedule_search(search_url)
+        avito_parser_logger.debug(f'Search of user {user_id} stopped: {search_url}')
+
+
+async def sync_subscriptions():
+    """Sync subscriptions registry and launched searches with users' searches in db."""
+    # Registry is read first, so searches started by events during db query aren't removed
+    launched_subscriptions = subscriptions.get_subscriptions()
+    all_searches = await db_aps.collect_searches()
+    db_subscriptions = {
+        (user_id, search_url)
+        for user_id, user_searches in all_searches.items()
+        for search_url in user_searches
+    }
+
+    for user_id, search_url in db_subscriptions - launched_subscriptions:
+        subscriptions.add_subscription(user_id, search_url)
+        await db_aps.add_launched_search(user_id, search_url)
+        if workers.owns_search(search_url):
+            scheduler.schedule_search(search_url)
+    for user_id, search_url in launched_subscriptions - db_subscriptions:
+        if subscriptions.remove_subscription(user_id, search_url):
+            scheduler.unschedule_search(search_url)
+        await db_aps.remove_launched_search(user_id, search_url)
+
+
+async def rebalance_searches():
+    """Schedule searches owned by this worker and unschedule searches of other workers.
+
+    Searches taken from other workers resume their stored schedule.
+    """
+    taken_search_urls = list()
+    for search_url in subscriptions.get_search_urls():
+        if workers.owns_search(search_url):
+            if not scheduler.is_scheduled(search_url):
+                taken_search_urls.append(search_url)
+        elif scheduler.is_scheduled(search_url):
+            scheduler.unschedule_search(search_url)
+    search_checks = await db_aps.get_search_checks(taken_search_urls)
+    scheduler.plan_warm_start(taken_search_urls, search_checks)
+
+
+async def check_search(search_url: str, bot: Bot) -> Optional[bool]:
+    """Check search and notify its subscribers about new and updated products.
+
+    Returns True if search has new or updated products,
+    None if search has no subscribers anymore or it belongs to another worker.
+    """
+    subscribers = subscriptions.get_subscribers(search_url)
+    if not subscribers or not workers.owns_search(search_url):
+        return None
+    try:
+        return await parse_and_handle_avito_products_update(search_url, subscribers, bot)
+    except StreamError:
+        avito_parser_logger.error(f'Got StreamError for {search_url}')
+    except CancelledError:  # Search was stopped, it's an Exception subclass before python 3.8
+        raise
+    except Exception:
+        await utils.handle_exception('avito_parser_logger')
+    return False
+
+
+async def parse_and_handle_avito_products_update(search_url: str, user_ids: Iterable[str],
+                                                 bot: Bot) -> bool:
+    """Parse avito url once, find new and updated products and send notify to every user.
+
+    Search pages are skipped without db queries for products if page wasn't modified
+    or its fingerprint (product ids with prices and subscribers) is the same
+    as fingerprint of the last fully handled page.
+    Returns True if any user got new or updated products.
+    """
+    last_fingerprint = await db_aps.get_search_fingerprint(search_url)
+    subscribers_fingerprint = get_fingerprint(user_ids)
+    is_same_subscribers = last_fingerprint.get('subscribers') == subscribers_fingerprint
+    validators = dict()
+    if is_same_subscribers:  # New subscribers should get products of unmodified page too
+        validators = {
+            header: value for header, value in last_fingerprint.items()
+            if header in VALIDATOR_HEADERS
+        }
+    product_infos, validators = await get_search_product_infos(search_url, validators)
+    if product_infos is None:
+        avito_parser_logger.debug(f'Search page was not modified: {search_url}')
+        return False
+    listing_fingerprint = get_fingerprint(
+        f'{product_info["product_id"]}:{product_info["price"]}' for product_info in product_infos
+    )
+    if is_same_subscribers and last_fingerprint.get('listing') == listing_fingerprint:
+        avito_parser_logger.debug(f'Search page has the same fingerprint: {search_url}')
+        return False
 
-async def parse_and_handle_avito_products_update(search_url: str, user_id: str,
-                                                 bot: Bot):
-    """Parse avito url, find new and updated products and send notify to user."""
-    avito_page = await get_avito_soup_page(search_url)
-    if not avito_page:
-        raise StreamError('Failed to download search page.')
-    products = collect_products(avito_page)
-    product_infos = parse_product_infos(products)
-    new_products, updated_products = db_aps.find_new_and_updated_products(product_infos, user_id)
+    products_updates = await find_products_updates(product_infos, user_ids)
+    pages_depth = await db_aps.get_search_pages_depth(search_url)
+    if pages_depth > 1 and has_new_products(products_updates):
+        product_infos, products_updates = await crawl_next_pages(
+            search_url, user_ids, pages_depth, product_infos, products_updates)
 
+    has_changes = False
     product_coros = []
-    for product_info in new_products:
-        task = bot.loop.create_task(parse_img_and_send_product_update(bot, user_id,
-                                                                      product_info, search_url))
-        product_coros.append(task)
-    for product_info in updated_products:
-        task = bot.loop.create_task(parse_img_and_send_product_update(bot, user_id, product_info,
-                                                                      search_url, False))
-        product_coros.append(task)
-
-    while product_coros:
-        await sleep(60)
-        for coro in product_coros.copy():
-            if coro.done():
-                product_coros.remove(coro)
-            sleep(0)
+    for user_id, (new_products, updated_products) in products_updates.items():
+        await db_aps.track_products_presence(product_infos, user_id, search_url)
+        has_changes = has_changes or bool(new_products or updated_products)
+        for product_info in new_products:
+            product_coros.append(parse_img_and_send_product_update(
+                bot, user_id, dict(product_info), search_url))
+        for product_info in updated_products:
+            product_coros.append(parse_img_and_send_product_update(
+                bot, user_id, dict(product_info), search_url, False))
+
+    results = await gather(*product_coros, return_exceptions=True)
+    is_handled = bool(product_infos)  # Empty search page is more likely broken than really empty
+    for result in results:
+        if isinstance(result, PERMANENT_DELIVERY_ERRORS):
+            avito_parser_logger.warning(f'Product update can\'t be delivered: {result!r}')
+        elif isinstance(result, Exception):
+            is_handled = False  # Page has to be handled again to retry failed updates
+            avito_parser_logger.error(f'Failed to send product update: {result!r}',
+                                      exc_info=result)
+    if is_handled:
+        await db_aps.store_search_fingerprint(search_url, dict(
+            validators, listing=listing_fingerprint, subscribers=subscribers_fingerprint))
     avito_parser_logger.debug('Products update had been parsed')
+    return has_changes
+
+
+async def find_products_updates(product_infos: List[dict],
+                                user_ids: Iterable[str]) -> Dict[str, Tuple[list, list]]:
+    """Find new and updated products of every user."""
+    return {
+        user_id: await db_aps.find_new_and_updated_products(product_infos, user_id)
+        for user_id in user_ids
+    }
+
+
+def has_new_products(products_updates: Dict[str, Tuple[list, list]]) -> bool:
+    """Check that any user has new products."""
+    return any(new_products for new_products, _ in products_updates.values())
+
+
+async def crawl_next_pages(
+        search_url: str, user_ids: Iterable[str], pages_depth: int,
+        product_infos: List[dict], products_updates: Dict[str, Tuple[list, list]],
+) -> Tuple[List[dict], Dict[str, Tuple[list, list]]]:
+    """Crawl search pages after the first one until page without new products.
+
+    Pages are fetched by SEARCH_PAGES_CONCURRENCY at once, crawl also stops
+    at the last (not full) page and at failed page. Products which moved
+    to the next page during crawl are skipped.
+    Returns product infos and products updates of all crawled pages.
+    """
+    product_infos = list(product_infos)
+    products_updates = {
+        user_id: (list(new_products), list(updated_products))
+        for user_id, (new_products, updated_products) in products_updates.items()
+    }
+    crawled_product_ids = {product_info['product_id'] for product_info in product_infos}
+    page_size = len(product_infos)
+    for first_page_number in range(2, pages_depth + 1, SEARCH_PAGES_CONCURRENCY):
+        page_numbers = range(first_page_number,
+                             min(first_page_number + SEARCH_PAGES_CONCURRENCY, pages_depth + 1))
+        pages = await gather(*[
+            get_next_search_page_product_infos(search_url, page_number)
+            for page_number in page_numbers
+        ], return_exceptions=True)
+        for page_number, page in zip(page_numbers, pages):
+            if isinstance(page, BaseException):  # CancelledError isn't Exception since 3.8
+                avito_parser_logger.debug(f'Failed to crawl page {page_number}: {page!r}')
+                return product_infos, products_updates
+            page_product_infos = [
+                product_info for product_info in page
+                if product_info['product_id'] not in crawled_product_ids
+            ]
+            crawled_product_ids.update(
+                product_info['product_id'] for product_info in page_product_infos)
+            product_infos.extend(page_product_infos)
+            page_updates = await find_products_updates(page_product_infos, user_ids)
+            for user_id, (new_products, updated_products) in page_updates.items():
+                products_updates[user_id][0].extend(new_products)
+                products_updates[user_id][1].extend(updated_products)
+            if len(page) < page_size or not has_new_products(page_updates):
+                avito_parser_logger.debug(f'Crawl of {search_url} stopped at page {page_number}')
+                return product_infos, products_updates
+    return product_infos, products_updates
+
+
+def get_search_page_url(search_url: str, page_number: int) -> str:
+    """Get url of search results page, Avito numbers pages with p query parameter."""
+    url_parts = urlsplit(search_url)
+    query = [
+        (parameter, value)
+        for parameter, value in parse_qsl(url_parts.query, keep_blank_values=True)
+        if parameter != 'p'
+    ]
+    query.append(('p', str(page_number)))
+    return urlunsplit(url_parts._replace(query=urlencode(query)))
+
+
+def get_fingerprint(values: Iterable[str]) -> str:
+    """Get compact fingerprint of values, order of values doesn't matter."""
+    return sha1('\n'.join(sorted(values)).encode('utf-8')).hexdigest()
 
 
 async def parse_img_and_send_product_update(bot: Bot, user_id: str, product_info: dict,
@@ -115,9 +326,11 @@ async def parse_img_and_send_product_update(bot: Bot, user_id: str, product_info
     if is_new_product:
         msg_type = phrases.new_advert
 
-    # TODO set product img url to db and check if it is already parsed
     try:
-        product_info['img_url'] = await get_product_image_url(product_info['product_url'])
+        if not (IMG_SOURCE == 'search' and product_info.get('img_url')):
+            product_info['img_url'] = await get_cached_product_image_url(product_info)
+    except CancelledError:
+        raise
     except Exception:  # Image parsing is now in debugging state
         product_info['img_url'] = DEFAULT_IMG
         await utils.handle_exception('avito_parser_logger', 'image_parse')
@@ -128,53 +341,145 @@ async def parse_img_and_send_product_update(bot: Bot, user_id: str, product_info
         url=product_info['product_url']
     )
 
-    await bot.send_photo(user_id, product_info['img_url'], caption=message)
-    db_aps.store_watched_product_info(product_info, user_id, search_url)
+    await delivery.send_photo(bot, user_id, product_info['img_url'], caption=message)
+    await db_aps.store_watched_product_info(product_info, user_id, search_url)
     avito_parser_logger.debug(f'Sent all product updates to {user_id}')
 
 
+async def get_cached_product_image_url(product_info: dict) -> str:
+    """Get product image url from in-process LRU cache, db cache or product page.
+
+    Concurrent requests for the same product wait for one product page download.
+    """
+    product_id = product_info['product_id']
+    img_url = _img_urls.get(product_id)
+    if img_url:
+        _img_urls.move_to_end(product_id)
+        return img_url
+
+    img_url_task = _img_url_tasks.get(product_id)
+    if not img_url_task:
+        img_url_task = ensure_future(_fetch_and_cache_product_image_url(product_info))
+        _img_url_tasks[product_id] = img_url_task
+        img_url_task.add_done_callback(lambda _: _img_url_tasks.pop(product_id, None))
+    return await shield(img_url_task)
+
+
+async def _fetch_and_cache_product_image_url(product_info: dict) -> str:
+    """Get product image url from db cache or product page and store it in caches."""
+    product_id = product_info['product_id']
+    img_url = await db_aps.get_product_img_url(product_id)
+    if not img_url:
+        img_url = await get_product_image_url(product_info['product_url'])
+        if img_url == DEFAULT_IMG:  # Don't cache failed parsing
+            return img_url
+        await db_aps.store_product_img_url(product_id, img_url)
+
+    _img_urls[product_id] = img_url
+    if len(_img_urls) > IMG_URLS_CACHE_SIZE:
+        _img_urls.popitem(last=False)
+    return img_url
+
+
 async def get_product_image_url(product_url: str) -> str:
     """Get product image url from product page."""
-    response = await utils.make_get_request(product_url, headers=db_aps.PRODUCT_HEADERS)
-    if not response:
+    response = await utils.make_get_request(product_url, headers=db_aps.PRODUCT_HEADERS,
+                                            budget='product')
+    if not response or not response.is_success:  # Removed or redirected product too
         avito_parser_logger.debug('Failed to parse product image. Set default url')
         return DEFAULT_IMG
 
-    page_data = BeautifulSoup(response.text, 'lxml')
-    img_frame_selectors = ('.gallery-img-frame', '.image-frame-wrapper-2FMhm')
-    try:
-        for selector in img_frame_selectors:
-            img_url = page_data.select_one(selector)
-            if img_url:
-                break
-        img_url = str(img_url['data-url'])
-    except TypeError:
+    img_url = await page_parser.run_parser(page_parser.parse_product_image_url,
+                                           response.content)
+    if not img_url:
         # Sometimes request fetch page with no product image,
         # so there is no gallery-img-frame in it.
         logger = utils.get_logger_bot()
         chat_id = os.environ.get('TG_LOG_CHAT_ID')
         text = f'into_image_parse: response.code: {response.status_code}\nurl: {product_url}'
-        await utils.handle_exception('avito_parser_logger', text)
+        avito_parser_logger.error(text)
         try:
-            await logger.send_document(chat_id, ('resp_text_page.html', response.text.encode()))
-            await logger.send_document(chat_id, ('product_page.html', page_data.encode()))
+            await utils.send_error_log_async_to_telegram(text)
+            await logger.send_document(chat_id, ('resp_text_page.html', response.content))
         except Exception:
-            utils.handle_exception('avito_parser_logger', 'into_image_parse')
-        finally:
-            return DEFAULT_IMG
+            await utils.handle_exception('avito_parser_logger', 'into_image_parse')
+        return DEFAULT_IMG
     avito_parser_logger.debug(f'Got product image url: {img_url}')
     return img_url
 
 
-async def get_avito_soup_page(url: str) -> BeautifulSoup:
-    """Get website (avito) response and parse with BS4."""
-    response = await utils.make_get_request(url, headers=SEARCH_HEADERS)
+async def get_search_product_infos(
+        search_url: str, validators: Optional[Dict[str, str]] = None, attempts: int = 100,
+) -> Tuple[Optional[List[dict]], Dict[str, str]]:
+    """Download search page and parse product infos from it.
+
+    validators are ETag and Last-Modified of previously downloaded page,
+    they are sent as conditional request headers. Returns product infos
+    (None if page wasn't modified) and validators of downloaded page.
+    """
+    response = await get_avito_search_page(search_url, validators, attempts)
+    if not response:
+        raise StreamError('Failed to download search page.')
+    if response.status_code == codes.NOT_MODIFIED:
+        return None, dict(validators or {})
+    if not response.is_success:
+        raise StreamError(f'Search page answered with status code {response.status_code}.')
+    page_validators = {
+        header: response.headers[header]
+        for header in VALIDATOR_HEADERS if header in response.headers
+    }
+    return await run_search_page_parser(response.content), page_validators
+
+
+async def get_next_search_page_product_infos(search_url: str, page_number: int) -> List[dict]:
+    """Download search page after the first one and parse product infos from it.
+
+    Page after the last one is answered with redirect, empty list is returned for it.
+    """
+    response = await get_avito_search_page(get_search_page_url(search_url, page_number),
+                                           attempts=SEARCH_PAGE_ATTEMPTS)
+    if not response:
+        raise StreamError(f'Failed to download search page {page_number}.')
+    if response.is_redirect:
+        avito_parser_logger.debug(f'Search page {page_number} redirects, it\'s after the last one')
+        return []
+    if not response.is_success:
+        raise StreamError(f'Search page answered with status code {response.status_code}.')
+    return await run_search_page_parser(response.content)
+
+
+async def run_search_page_parser(page: bytes) -> List[dict]:
+    """Parse product infos from search page with SEARCH_PAGE_PARSER."""
+    if SEARCH_PAGE_PARSER == 'bs4':
+        return await page_parser.run_parser(parse_search_page_bs4, page)
+    if SEARCH_PAGE_PARSER == 'lxml':
+        return await page_parser.run_parser(page_parser.parse_search_page, page)
+    return await page_parser.run_parser(page_parser.parse_search_page_json, page)
+
+
+async def get_avito_search_page(url: str, validators: Optional[Dict[str, str]] = None,
+                                attempts: int = 100) -> Optional[Response]:
+    """Get website (avito) response, conditional one if validators are given.
+
+    Any redirect to avito is returned without retries, for search
+    it's the same through every proxy.
+    """
+    headers = dict(SEARCH_HEADERS)
+    for header, value in (validators or {}).items():
+        headers[VALIDATOR_HEADERS[header]] = value
+    response = await utils.make_get_request(url, headers=headers, attempts=attempts,
+                                            is_site_redirect=utils.is_same_site)
     if not response:
         avito_parser_logger.debug(f'Failed to get response from avito page: {url}')
-        return
+        return None
+
+    avito_parser_logger.debug(f'Got {response.status_code} response from avito')
+    return response
+
 
-    avito_parser_logger.debug('Got 200 response from avito, soup page returned')
-    return BeautifulSoup(response.text, 'lxml')
+def parse_search_page_bs4(page: bytes) -> List[dict]:
+    """Parse product infos from search page with BeautifulSoup."""
+    return parse_product_infos(collect_products(BeautifulSoup(page, 'lxml')))
 
 
 def collect_products(page: BeautifulSoup) -> list:
@@ -201,7 +506,7 @@ def collect_products(page: BeautifulSoup) -> list:
 def parse_product_infos(products: list) -> List[dict]:
     """Parse info about products.
 
-    Dict keys: product_id, title, price, product_url, pub_date
+    Dict keys: product_id, title, price, product_url, pub_date, img_url
     """
     product_infos = []
     for product in products:
@@ -213,7 +518,11 @@ def parse_product_infos(products: list) -> List[dict]:
                 product.select_one('.snippet-link')['href']
             ),
             'pub_date': product.select_one('.snippet-date-info')['data-tooltip'],
+            'img_url': None,
         }
+        thumbnail = product.select_one('img')
+        if thumbnail:
+            product_info['img_url'] = page_parser.select_img_url(thumbnail.attrs)
         product_infos.append(product_info)
     avito_parser_logger.debug('Parsed product infos')
     return product_infos
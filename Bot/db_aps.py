@@ -1,11 +1,12 @@
-from asyncio import sleep
+from asyncio import gather, Lock, Semaphore, sleep
 import json
 from logging import getLogger
 import os
-from random import randint
-from typing import Tuple, Union, Optional
+from time import time
+from typing import AsyncIterator, Dict, List, Set, Tuple, Union, Optional
 
-import redis
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
+import aioredis
 
 import utils
 
@@ -13,10 +14,61 @@ import utils
 db_logger = getLogger('db_logger')
 
 _database = None
+_database_lock = Lock()
+_storage = None
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+PRODUCT_TTL = int(os.getenv('PRODUCT_TTL', 2592000))  # 30 days
+IMG_URL_TTL = int(os.getenv('IMG_URL_TTL', 604800))  # 7 days
+EXPIRY_CANDIDATE_CYCLES = int(os.getenv('EXPIRY_CANDIDATE_CYCLES', 3))
+COLLECTOR_CONCURRENCY = int(os.getenv('COLLECTOR_CONCURRENCY', 10))
+COLLECTOR_BATCH_SIZE = int(os.getenv('COLLECTOR_BATCH_SIZE', 100))
+# Unchanged search pages are fully handled at least once per TTL, so that TTL
+# of seen products is refreshed and missing products are counted, keep it below PRODUCT_TTL
+SEARCH_FINGERPRINT_TTL = int(os.getenv('SEARCH_FINGERPRINT_TTL', 86400))  # 1 day
+SEARCH_PAGES_DEPTH = int(os.getenv('SEARCH_PAGES_DEPTH', 1))
+EXPIRATION_MARKERS = [b'item-closed-warning', b'item-view-warning-content']
+# Expiration warnings are at the top of product page, there is no need to read page after them
+EXPIRY_CHECK_STOP_MARKER = os.getenv('EXPIRY_CHECK_STOP_MARKER', 'item-description').encode()
 
 DB_PRODUCT_PREFIX = 'avito:product_info:'
 DB_SEARCH_PREFIX = 'avito:user_search:'
-DB_LAUNCHED_SEARCHES = 'avito:launched_searches'
+DB_LAUNCHED_SEARCHES = 'avito:launched_searches'  # Old JSON lists hash, see migration
+DB_SEARCH_SUBSCRIBERS_PREFIX = 'avito:search_subscribers:'
+DB_LAUNCHED_SEARCH_URLS = 'avito:launched_search_urls'
+DB_SEARCH_CHECKED_AT = 'avito:search_checked_at'
+DB_SEARCH_INTERVALS = 'avito:search_intervals'
+DB_USERS = 'avito:users'
+DB_PRODUCTS = 'avito:products'  # Old global products index, see migration
+DB_USER_PRODUCTS_PREFIX = 'avito:user_products:'
+DB_SEARCH_PRODUCTS_PREFIX = 'avito:search_products:'
+DB_SEARCH_MISSED_CYCLES_PREFIX = 'avito:search_missed_cycles:'
+DB_EXPIRY_CANDIDATES = 'avito:expiry_candidates'
+DB_PRODUCT_IMG_PREFIX = 'avito:product_img:'
+DB_COLLECTOR_CURSOR = 'avito:expired_collector:cursor'
+DB_SEARCH_FINGERPRINT_PREFIX = 'avito:search_fingerprint:'
+DB_SEARCH_PAGES_DEPTHS = 'avito:search_pages_depths'
+DB_INDEXES_VERSION = 'avito:indexes_version'
+DB_SEARCH_EVENTS_CHANNEL = 'avito:search_events'
+DB_WORKERS = 'avito:workers'
+DB_LEASE_PREFIX = 'avito:lease:'
+COLLECTOR_LEASE = 'expired_collector'
+COLLECTOR_LEASE_TTL = int(os.getenv('COLLECTOR_LEASE_TTL', 30))  # Prolonged by worker heartbeat
+PROLONG_LEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+RELEASE_LEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+SEARCH_STARTED = 'start'
+SEARCH_STOPPED = 'stop'
+INDEXES_VERSION = 3
 PRODUCT_HEADERS = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
     'Accept-Encoding': 'gzip, deflate, br',
@@ -30,44 +82,183 @@ PRODUCT_HEADERS = {
 }  # Сommented headers are left for possible request checks
 
 
-def get_database_connection() -> redis.Redis:
-    """Get or create Redis db connection."""
+def share_storage_pool(storage: RedisStorage2):
+    """Use Redis connection pool of aiogram FSM storage for db queries."""
+    global _storage
+    _storage = storage
+
+
+async def get_database_connection() -> aioredis.Redis:
+    """Get or create Redis db connection pool.
+
+    Pool of aiogram FSM storage is used if it was shared by share_storage_pool.
+    """
     global _database
-    if _database is None:
-        database_password = os.getenv('DB_PASSWORD')
-        database_host = os.getenv('DB_HOST')
-        database_port = os.getenv('DB_PORT')
-        _database = redis.Redis(host=database_host, port=database_port,  # type: ignore
-                                password=database_password)
-        db_logger.debug('Got new db connection')
+    if _storage is not None:
+        return await _storage.redis()
+    async with _database_lock:
+        if _database is None or _database.closed:
+            _database = await aioredis.create_redis_pool(
+                (os.getenv('DB_HOST'), os.getenv('DB_PORT')), password=os.getenv('DB_PASSWORD'),
+                minsize=1, maxsize=DB_POOL_SIZE,
+            )
+            db_logger.debug('Got new db connection pool')
     return _database
 
 
-def find_new_and_updated_products(product_infos: list, user_id) -> Tuple[list, list]:
-    """Find new and updated products."""
-    db = get_database_connection()
+async def publish_search_event(event: str, user_id: str, search_url: str):
+    """Publish search start or stop event for parser."""
+    db = await get_database_connection()
+    await db.publish_json(DB_SEARCH_EVENTS_CHANNEL, {
+        'event': event,
+        'user_id': str(user_id),
+        'search_url': search_url,
+    })
+
+
+async def listen_search_events() -> AsyncIterator[dict]:
+    """Listen search events and yield them until connection is lost.
+
+    Subscribed connection can't run other commands, so dedicated
+    connection is used instead of pool one.
+    """
+    connection = await aioredis.create_redis(
+        (os.getenv('DB_HOST'), os.getenv('DB_PORT')), password=os.getenv('DB_PASSWORD'))
+    try:
+        channel, = await connection.subscribe(DB_SEARCH_EVENTS_CHANNEL)
+        db_logger.debug('Subscribed to search events')
+        async for event in channel.iter(encoding='utf-8', decoder=json.loads):
+            yield event
+    finally:
+        connection.close()
+        await connection.wait_closed()
+
+
+async def find_new_and_updated_products(product_infos: list, user_id) -> Tuple[list, list]:
+    """Find new and updated products.
+
+    Stored prices of all products are fetched with one pipelined round trip.
+    """
+    db = await get_database_connection()
+    pipeline = db.pipeline()
+    for product in product_infos:
+        pipeline.hget(f'{DB_PRODUCT_PREFIX}{user_id}:{product["product_id"]}', 'price')
+    db_prices = await pipeline.execute()
+
     new_products = []
     updated_products = []
-    for product in product_infos:
-        db_product = db.hgetall(f'{DB_PRODUCT_PREFIX}{user_id}:{product["product_id"]}')
-        if not db_product:
+    for product, db_price in zip(product_infos, db_prices):
+        if db_price is None:
             new_products.append(product)
             continue
-        if product['price'] != db_product[b'price'].decode('utf-8'):
+        if normalize_price(product['price']) != normalize_price(db_price.decode('utf-8')):
             updated_products.append(product)
     db_logger.debug(f'Found {len(new_products)} new and {len(updated_products)} updated products')
     return new_products, updated_products
 
 
-def store_watched_product_info(product_info: dict, user_id: str, search_url: str) -> None:
-    """Store product into redis db."""
-    db = get_database_connection()
+def normalize_price(price: str) -> str:
+    """Keep only price digits, so that price formatting of page parsers doesn't matter."""
+    return ''.join(char for char in price if char.isdigit()) or price
+
+
+async def track_products_presence(product_infos: list, user_id: str, search_url: str):
+    """Count search cycles in a row, in which stored products were missing from search results.
+
+    Products missing for EXPIRY_CANDIDATE_CYCLES become expiry candidates once, only they
+    are checked by expired products collector. Missing products are never deleted
+    without product page check: they may have just moved to the next search pages.
+    TTL of products seen in search is refreshed, others age out by TTL.
+    Index entries of products expired by TTL are removed.
+    """
+    if not product_infos:  # Empty search page is more likely broken than really empty
+        return
+    db = await get_database_connection()
+    missed_cycles_key = f'{DB_SEARCH_MISSED_CYCLES_PREFIX}{user_id}:{search_url}'
+    stored_keys = await db.smembers(f'{DB_SEARCH_PRODUCTS_PREFIX}{user_id}:{search_url}')
+    found_keys = {
+        f'{DB_PRODUCT_PREFIX}{user_id}:{product["product_id"]}'.encode('utf-8')
+        for product in product_infos
+    }
+    seen_keys = [key for key in stored_keys if key in found_keys]
+    missing_keys = [key for key in stored_keys if key not in found_keys]
+    aged_out_keys = []
+    if missing_keys:  # Products expired by TTL are left only in indexes
+        pipeline = db.pipeline()
+        for key in missing_keys:
+            pipeline.exists(key)
+        keys_exist = await pipeline.execute()
+        aged_out_keys = [key for key, exists in zip(missing_keys, keys_exist) if not exists]
+        missing_keys = [key for key, exists in zip(missing_keys, keys_exist) if exists]
+
+    pipeline = db.pipeline()
+    for key in missing_keys:
+        pipeline.hincrby(missed_cycles_key, key)
+    if seen_keys:
+        pipeline.hdel(missed_cycles_key, *seen_keys)
+        pipeline.srem(DB_EXPIRY_CANDIDATES, *seen_keys)
+    for key in seen_keys:
+        pipeline.expire(key, PRODUCT_TTL)
+    if aged_out_keys:
+        pipeline.srem(f'{DB_SEARCH_PRODUCTS_PREFIX}{user_id}:{search_url}', *aged_out_keys)
+        pipeline.srem(f'{DB_USER_PRODUCTS_PREFIX}{user_id}', *aged_out_keys)
+        pipeline.hdel(missed_cycles_key, *aged_out_keys)
+        pipeline.srem(DB_EXPIRY_CANDIDATES, *aged_out_keys)
+    missed_cycles = (await pipeline.execute())[:len(missing_keys)]
+
+    candidate_keys = [
+        key for key, key_missed_cycles in zip(missing_keys, missed_cycles)
+        if key_missed_cycles == EXPIRY_CANDIDATE_CYCLES
+    ]
+    if candidate_keys:
+        await db.sadd(DB_EXPIRY_CANDIDATES, *candidate_keys)
+    db_logger.debug(f'{len(missing_keys)} products of user {user_id} are missing from search, '
+                    f'{len(candidate_keys)} of them are expiry candidates, '
+                    f'{len(aged_out_keys)} expired by TTL')
+
+
+async def get_search_fingerprint(search_url: str) -> Dict[str, str]:
+    """Get fingerprint of the last fully handled search page."""
+    db = await get_database_connection()
+    return await db.hgetall(f'{DB_SEARCH_FINGERPRINT_PREFIX}{search_url}', encoding='utf-8')
+
+
+async def store_search_fingerprint(search_url: str, fingerprint: Dict[str, str]):
+    """Store fingerprint of fully handled search page for SEARCH_FINGERPRINT_TTL."""
+    db = await get_database_connection()
+    db_key = f'{DB_SEARCH_FINGERPRINT_PREFIX}{search_url}'
+    transaction = db.multi_exec()
+    transaction.delete(db_key)
+    transaction.hmset_dict(db_key, fingerprint)
+    transaction.expire(db_key, SEARCH_FINGERPRINT_TTL)
+    await transaction.execute()
+
+
+async def get_search_pages_depth(search_url: str) -> int:
+    """Get amount of search pages to crawl, SEARCH_PAGES_DEPTH if it isn't set for search."""
+    db = await get_database_connection()
+    pages_depth = await db.hget(DB_SEARCH_PAGES_DEPTHS, search_url)
+    return int(pages_depth) if pages_depth else SEARCH_PAGES_DEPTH
+
+
+async def set_search_pages_depth(search_url: str, pages_depth: Optional[int]):
+    """Set amount of search pages to crawl, None resets it to SEARCH_PAGES_DEPTH."""
+    db = await get_database_connection()
+    if pages_depth is None:
+        await db.hdel(DB_SEARCH_PAGES_DEPTHS, search_url)
+    else:
+        await db.hset(DB_SEARCH_PAGES_DEPTHS, search_url, pages_depth)
+
+
+async def store_watched_product_info(product_info: dict, user_id: str, search_url: str) -> None:
+    """Store product into redis db.
+
+    Product expires in PRODUCT_TTL seconds, unless it's seen in search again.
+    """
+    db = await get_database_connection()
     product_key = f'{DB_PRODUCT_PREFIX}{user_id}:{product_info["product_id"]}'
-    # TODO check, if all product ads expires every month? even after edits?
-    # If they do, we can set "expires" value to db product entry and help
-    # expired products collector (he then can check, if product expires soon
-    # and not handle it)
-    db.hmset(
+    transaction = db.multi_exec()
+    transaction.hmset_dict(
         product_key,
         {
             'product_id': product_info['product_id'],
@@ -77,107 +268,248 @@ def store_watched_product_info(product_info: dict, user_id: str, search_url: str
             'search_url': search_url,
         }
     )
+    transaction.expire(product_key, PRODUCT_TTL)
+    transaction.sadd(f'{DB_USER_PRODUCTS_PREFIX}{user_id}', product_key)
+    transaction.sadd(f'{DB_SEARCH_PRODUCTS_PREFIX}{user_id}:{search_url}', product_key)
+    await transaction.execute()
     db_logger.debug(f'Stored {product_key}')
 
 
-def collect_searches() -> dict:
+async def get_product_img_url(product_id: str) -> Optional[str]:
+    """Get cached product image url."""
+    db = await get_database_connection()
+    img_url = await db.get(f'{DB_PRODUCT_IMG_PREFIX}{product_id}')
+    if not img_url:
+        return None
+    return img_url.decode('utf-8')
+
+
+async def store_product_img_url(product_id: str, img_url: str):
+    """Cache product image url for all users, it expires in IMG_URL_TTL seconds."""
+    db = await get_database_connection()
+    await db.setex(f'{DB_PRODUCT_IMG_PREFIX}{product_id}', IMG_URL_TTL, img_url)
+    db_logger.debug(f'Cached image url of product {product_id}')
+
+
+async def collect_searches() -> dict:
     """Collect all existing searches from db."""
-    db = get_database_connection()
-    search_pattern = f'{DB_SEARCH_PREFIX}*'
-    search_keys = db.keys(pattern=search_pattern)
-    search_keys = [key.decode('utf-8') for key in search_keys]
-    search_keys = remove_banned_users(search_keys)
+    db = await get_database_connection()
+    user_ids = [user_id.decode('utf-8') for user_id in await db.smembers(DB_USERS)]
+    user_ids = remove_banned_users(user_ids)
+    pipeline = db.pipeline()
+    for user_id in user_ids:
+        pipeline.hvals(f'{DB_SEARCH_PREFIX}{user_id}')
     searches = {}
-    for key in search_keys:
-        user_id = key.split(':')[-1]
-        user_searches = {search_url.decode('utf-8') for search_url in db.hvals(key)}
-        searches[user_id] = user_searches
+    for user_id, search_urls in zip(user_ids, await pipeline.execute()):
+        searches[user_id] = {search_url.decode('utf-8') for search_url in search_urls}
     db_logger.debug(f'Collected {len(searches)} searches')
     return searches
 
 
-def remove_banned_users(search_keys: list) -> list:
-    """Remove banned users from search keys."""
+def remove_banned_users(user_ids: list) -> list:
+    """Remove banned users from user ids."""
     banned_users = os.environ.get('BAN_LIST')
     if not banned_users:
-        return search_keys
+        return user_ids
     else:
         banned_users = banned_users.split(',')  # type: ignore
 
-    for key in search_keys.copy():
-        if key in banned_users:
-            search_keys.remove(key)
-    return search_keys
+    for user_id in user_ids.copy():
+        if user_id in banned_users:
+            user_ids.remove(user_id)
+    return user_ids
 
 
-async def start_expired_products_collector(sleep_time: int = 43200):
-    """Runs collector witch remove expired products from db."""
-    while True:
+async def start_expired_products_collector(sleep_time: int = 43200, worker_id: str = ''):
+    """Runs collector witch remove expired products from db.
+
+    Collector pass interrupted by restart is resumed right after start.
+    Passes are run only by worker holding collector lease. Lease is short,
+    alive holder keeps it with heartbeats (see workers), so dead holder
+    is replaced by another worker in COLLECTOR_LEASE_TTL sec.
+    """
+    db = await get_database_connection()
+    if not await db.exists(DB_COLLECTOR_CURSOR):
         await sleep(sleep_time)
+    while True:
+        if not await acquire_lease(COLLECTOR_LEASE, worker_id, COLLECTOR_LEASE_TTL):
+            db_logger.debug('Collector lease is held by another worker')
+            await sleep(COLLECTOR_LEASE_TTL)
+            continue
         db_logger.debug('Starting new cycle stage of expired products collector')
         try:
             await find_expired_products()
         except Exception:
             await utils.handle_exception('expired_products_logger')
         db_logger.debug(f'Expired products collector starts sleeping for {sleep_time} sec')
+        await sleep(sleep_time)
+
+
+async def acquire_lease(name: str, owner: str, ttl: int) -> bool:
+    """Acquire or prolong lease for ttl sec. Returns True if owner holds lease."""
+    db = await get_database_connection()
+    lease_key = f'{DB_LEASE_PREFIX}{name}'
+    if await db.set(lease_key, owner, expire=ttl, exist=db.SET_IF_NOT_EXIST):
+        return True
+    return await prolong_lease(name, owner, ttl)
+
+
+async def prolong_lease(name: str, owner: str, ttl: int) -> bool:
+    """Prolong lease for ttl sec if owner holds it. Returns True if owner holds lease."""
+    db = await get_database_connection()
+    lease_key = f'{DB_LEASE_PREFIX}{name}'
+    return bool(await db.eval(PROLONG_LEASE_SCRIPT, keys=[lease_key], args=[owner, ttl]))
+
+
+async def release_lease(name: str, owner: str):
+    """Release lease if owner holds it."""
+    db = await get_database_connection()
+    lease_key = f'{DB_LEASE_PREFIX}{name}'
+    await db.eval(RELEASE_LEASE_SCRIPT, keys=[lease_key], args=[owner])
+
+
+async def register_worker_heartbeat(worker_id: str, timeout: int) -> List[str]:
+    """Store worker heartbeat, remove timed out workers and get live ones."""
+    db = await get_database_connection()
+    now = time()
+    transaction = db.multi_exec()
+    transaction.zadd(DB_WORKERS, now, worker_id)
+    transaction.zremrangebyscore(DB_WORKERS, max=now - timeout)
+    transaction.zrange(DB_WORKERS, encoding='utf-8')
+    _, _, live_workers = await transaction.execute()
+    return live_workers
+
+
+async def remove_worker(worker_id: str):
+    """Remove worker from live workers."""
+    db = await get_database_connection()
+    await db.zrem(DB_WORKERS, worker_id)
 
 
 async def find_expired_products() -> None:
-    """Find and remove expired products from db."""
-    db = get_database_connection()
-    products_pattern = f'{DB_PRODUCT_PREFIX}*'
-    product_keys = db.keys(pattern=products_pattern)
-    expired_keys = []
-    for key in product_keys:
+    """Find and remove expired products from db.
+
+    Only expiry candidates (products missing from their search results for
+    several cycles) are checked. Candidates are scanned by batches, candidates
+    of a batch are checked concurrently and expired ones are deleted before
+    the next batch. Alive candidates are checked only once, they are left
+    to age out by TTL unless they are seen in search again.
+    Scan cursor is stored in db, so the pass can be resumed after restart.
+    """
+    db = await get_database_connection()
+    cursor = int(await db.get(DB_COLLECTOR_CURSOR) or 0)
+    semaphore = Semaphore(COLLECTOR_CONCURRENCY)
+    checked_amount = 0
+    expired_amount = 0
+    while True:
+        cursor, product_keys = await db.sscan(DB_EXPIRY_CANDIDATES, cursor,
+                                              count=COLLECTOR_BATCH_SIZE)
+        checks = await gather(*[
+            _check_expiration(key, semaphore) for key in product_keys
+        ])
+        expired_keys = [key for key, is_expired in zip(product_keys, checks) if is_expired]
+        if expired_keys:
+            await delete_products(expired_keys)
+        alive_keys = [key for key, is_expired in zip(product_keys, checks) if not is_expired]
+        if alive_keys:
+            await db.srem(DB_EXPIRY_CANDIDATES, *alive_keys)
+        checked_amount += len(product_keys)
+        expired_amount += len(expired_keys)
+
+        if not cursor:
+            await db.delete(DB_COLLECTOR_CURSOR)
+            break
+        await db.set(DB_COLLECTOR_CURSOR, cursor)
+    db_logger.debug(f'Checked {checked_amount} products, deleted {expired_amount} expired')
+
+
+async def _check_expiration(product_key: bytes, semaphore: Semaphore) -> bool:
+    """Check product expiration, no more than semaphore allows at once."""
+    async with semaphore:
         try:
-            if await _is_expired(key):
-                expired_keys.append(key)
+            return await _is_expired(product_key)
         except Exception:
             await utils.handle_exception('expired_products_logger')
-            continue
-        await sleep(randint(10, 20))
-
-    if expired_keys:
-        db.delete(*expired_keys)
-    db_logger.debug(f'Deleted {len(expired_keys)} expired keys from db')
+            return False
 
 
-async def _is_expired(product_key: str) -> bool:
-    """Get product page and check for expiration selectors in it."""
-    db = get_database_connection()
-    expiration_selectors = ['item-closed-warning', 'item-view-warning-content']
-    product_url = db.hget(product_key, 'product_url').decode('utf-8')
-    response = await utils.make_get_request(product_url, headers=PRODUCT_HEADERS)
-    if not response:
+async def delete_products(product_keys: list):
+    """Delete products and remove them from indexes."""
+    db = await get_database_connection()
+    pipeline = db.pipeline()
+    for key in product_keys:
+        pipeline.hget(key, 'search_url')
+    search_urls = await pipeline.execute()
+
+    transaction = db.multi_exec()
+    transaction.delete(*product_keys)
+    transaction.srem(DB_EXPIRY_CANDIDATES, *product_keys)
+    for key, search_url in zip(product_keys, search_urls):
+        user_id = get_product_user_id(key)
+        transaction.srem(f'{DB_USER_PRODUCTS_PREFIX}{user_id}', key)
+        if search_url:
+            search_url = search_url.decode('utf-8')
+            transaction.srem(f'{DB_SEARCH_PRODUCTS_PREFIX}{user_id}:{search_url}', key)
+            transaction.hdel(f'{DB_SEARCH_MISSED_CYCLES_PREFIX}{user_id}:{search_url}', key)
+    await transaction.execute()
+
+
+def get_product_user_id(product_key: Union[str, bytes]) -> str:
+    """Get user id from product key (product key is prefix:user_id:product_id)."""
+    if isinstance(product_key, bytes):
+        product_key = product_key.decode('utf-8')
+    return product_key[len(DB_PRODUCT_PREFIX):].rsplit(':', 1)[0]
+
+
+async def _is_expired(product_key: bytes) -> bool:
+    """Stream product page and check for expiration markers in it.
+
+    Page is read only until expiration marker or EXPIRY_CHECK_STOP_MARKER.
+    Removed page and redirect to another page of the site (category or search)
+    mean that product expired.
+    """
+    db = await get_database_connection()
+    product_url = await db.hget(product_key, 'product_url', encoding='utf-8')
+    if not product_url:  # Product was already deleted, only index entry is left
+        return True
+    check_result = await utils.find_response_markers(
+        product_url, EXPIRATION_MARKERS, EXPIRY_CHECK_STOP_MARKER or None,
+        headers=PRODUCT_HEADERS, budget='product',
+    )
+    if not check_result:
         return False
-    db_logger.debug(f'Got response status code {response.status_code}')
-    if response.status_code in (301, 302):
+    status_code, expiration_marker = check_result
+    db_logger.debug(f'Got response status code {status_code}')
+    if status_code in utils.REDIRECT_STATUS_CODES or status_code in utils.GONE_STATUS_CODES:
+        return True
+    if expiration_marker:
+        db_logger.debug(f'Found expiration marker {expiration_marker!r}')
         return True
-    for selector in expiration_selectors:
-        if response.text.find(selector) != -1:
-            return True
-            db_logger.debug('Found expiration selector')
     return False
 
 
-def add_new_search(user_id: str, url: str):
+async def add_new_search(user_id: str, url: str):
     """Add new search url to user's search hash."""
-    db = get_database_connection()
+    db = await get_database_connection()
     db_key = f'{DB_SEARCH_PREFIX}{user_id}'
-    existing_searches = db.hvals(db_key)
+    existing_searches = await db.hvals(db_key)
     if not existing_searches:
         search_number = 1
     else:
         search_number = len(existing_searches) + 1
-    db.hmset(db_key, {search_number: url})
+    transaction = db.multi_exec()
+    transaction.hmset_dict(db_key, {search_number: url})
+    transaction.sadd(DB_USERS, user_id)
+    await transaction.execute()
+    await publish_search_event(SEARCH_STARTED, user_id, url)
     db_logger.debug(f'Added new search {db_key}')
 
 
-def get_user_existing_searches(user_id: Union[str, int]):
+async def get_user_existing_searches(user_id: Union[str, int]):
     """Get user's existing searches."""
-    db = get_database_connection()
+    db = await get_database_connection()
     db_key = f'{DB_SEARCH_PREFIX}{user_id}'
-    existing_searches = db.hgetall(db_key)
+    existing_searches = await db.hgetall(db_key)
     if not existing_searches:
         return
     existing_searches = {
@@ -188,63 +520,72 @@ def get_user_existing_searches(user_id: Union[str, int]):
     return existing_searches
 
 
-def remove_search(user_id: str, search_number: str):
+async def remove_search(user_id: str, search_number: str):
     """Remove search, its products and update remaining searches hash keys."""
-    remove_products_by_search_number(user_id, search_number)
-    db = get_database_connection()
+    await remove_products_by_search_number(user_id, search_number)
+    db = await get_database_connection()
     db_key = f'{DB_SEARCH_PREFIX}{user_id}'
-    db.hdel(db_key, search_number)
-    remaining_searches = db.hvals(db_key)
+    await db.hdel(db_key, search_number)
+    remaining_searches = await db.hvals(db_key)
     if remaining_searches:
         updated_searches = {
             search_number+1: search_url
             for search_number, search_url in enumerate(remaining_searches)
         }
-        db.delete(db_key)
-        db.hmset(db_key, updated_searches)
+        await db.delete(db_key)
+        await db.hmset_dict(db_key, updated_searches)
+    else:
+        await db.srem(DB_USERS, user_id)
     db_logger.debug(f'Removed {search_number}\'th search of {user_id} user')
     return 'Поиск удален'
 
 
-def remove_products_by_search_number(user_id: str, search_number: str):
+async def remove_products_by_search_number(user_id: str, search_number: str):
     """Remove products of search."""
-    db = get_database_connection()
-    search_url = db.hget(f'{DB_SEARCH_PREFIX}{user_id}', search_number)
-    remove_launched_search(user_id, search_url.decode('utf-8'))
-    products_pattern = f'{DB_PRODUCT_PREFIX}{user_id}:*'
-    user_product_keys = db.keys(pattern=products_pattern)
-    keys_for_deletion = []
-    for key in user_product_keys:
-        if db.hget(key, 'search_url') == search_url:
-            keys_for_deletion.append(key)
+    db = await get_database_connection()
+    search_url = await db.hget(f'{DB_SEARCH_PREFIX}{user_id}', search_number)
+    search_url = search_url.decode('utf-8')
+    await remove_launched_search(user_id, search_url)
+    await publish_search_event(SEARCH_STOPPED, user_id, search_url)
+    search_products_key = f'{DB_SEARCH_PRODUCTS_PREFIX}{user_id}:{search_url}'
+    keys_for_deletion = await db.smembers(search_products_key)
 
     if not keys_for_deletion:
         db_logger.debug(f'Removed 0 products for search {search_number} of user {user_id}')
         return
-    db.delete(*keys_for_deletion)
+    transaction = db.multi_exec()
+    transaction.delete(search_products_key, *keys_for_deletion)
+    transaction.delete(f'{DB_SEARCH_MISSED_CYCLES_PREFIX}{user_id}:{search_url}')
+    transaction.srem(DB_EXPIRY_CANDIDATES, *keys_for_deletion)
+    transaction.srem(f'{DB_USER_PRODUCTS_PREFIX}{user_id}', *keys_for_deletion)
+    await transaction.execute()
     db_logger.debug(f'Removed products for search {search_number} of user {user_id}')
 
 
-def get_admins() -> Tuple[int, ...]:
+async def get_admins() -> Tuple[int, ...]:
     """Get admins from db."""
-    db = get_database_connection()
-    admins = [int(admin_id) for admin_id in db.lrange('avito:admin_list', 0, -1)]
+    db = await get_database_connection()
+    admins = [int(admin_id) for admin_id in await db.lrange('avito:admin_list', 0, -1)]
     return tuple(admins)
 
 
-def get_super_admin() -> int:
+async def get_super_admin() -> int:
     """Get super admin id."""
-    db = get_database_connection()
-    return int(db.get('avito:superadmin'))
+    db = await get_database_connection()
+    return int(await db.get('avito:superadmin'))
 
 
-def get_useful_db_info():
+async def get_useful_db_info():
     """Collect useful info about db."""
-    db = get_database_connection()
-    db_info = db.info()
-
-    input_MB = round(db_info['total_net_input_bytes']/1048576, 2)
-    output_MB = round(db_info['total_net_output_bytes']/1048576, 2)
+    db = await get_database_connection()
+    db_info = {
+        key: value
+        for section in (await db.info()).values()
+        for key, value in section.items()
+    }  # aioredis splits info by sections
+
+    input_MB = round(int(db_info['total_net_input_bytes'])/1048576, 2)
+    output_MB = round(int(db_info['total_net_output_bytes'])/1048576, 2)
     usefull_info = {
         'connected_clients': db_info['connected_clients'],
         'connected_slaves': db_info['connected_slaves'],
@@ -261,74 +602,168 @@ def get_useful_db_info():
     return usefull_info
 
 
-def get_users() -> Tuple[int, ...]:
+async def get_users() -> Tuple[int, ...]:
     """Count user ids in db."""
-    db = get_database_connection()
-    user_searches = db.keys(pattern=f'{DB_SEARCH_PREFIX}*')
-    user_ids = [
-        int(user_search.decode('utf-8').lstrip(DB_SEARCH_PREFIX))
-        for user_search in user_searches
-    ]
+    db = await get_database_connection()
+    user_ids = [int(user_id) for user_id in await db.smembers(DB_USERS)]
     return tuple(user_ids)
 
 
-def get_user_products_amount(user_id: Union[str, int]) -> int:
-    """Count user product keys."""
-    db = get_database_connection()
-    product_keys = db.keys(pattern=f'{DB_PRODUCT_PREFIX}{user_id}:*')
-    return len(product_keys)
+async def get_user_products_amount(user_id: Union[str, int]) -> int:
+    """Count user product keys, index entries of products expired by TTL are removed."""
+    db = await get_database_connection()
+    user_products_key = f'{DB_USER_PRODUCTS_PREFIX}{user_id}'
+    product_keys = await db.smembers(user_products_key)
+    pipeline = db.pipeline()
+    for key in product_keys:
+        pipeline.exists(key)
+    keys_exist = await pipeline.execute()
+    aged_out_keys = [key for key, exists in zip(product_keys, keys_exist) if not exists]
+    if aged_out_keys:
+        await db.srem(user_products_key, *aged_out_keys)
+    return len(product_keys) - len(aged_out_keys)
 
 
-def add_launched_search(user_id: str, search_url: str):
+async def add_launched_search(user_id: str, search_url: str):
     """Add search url into launched searches.
 
     We store launched searches separately from active user's searches,
     so that we can launch coroutines of the search process
     for newly added searches.
     """
-    db = get_database_connection()
-    raw_launched_urls = db.hget(DB_LAUNCHED_SEARCHES, str(user_id))
-    if raw_launched_urls:
-        launched_urls = json.loads(raw_launched_urls)
-        launched_urls.append(search_url)
-    else:
-        launched_urls = [search_url]
-    db.hset(DB_LAUNCHED_SEARCHES, str(user_id), json.dumps(launched_urls))
-
+    db = await get_database_connection()
+    transaction = db.multi_exec()
+    transaction.sadd(f'{DB_SEARCH_SUBSCRIBERS_PREFIX}{search_url}', user_id)
+    transaction.sadd(DB_LAUNCHED_SEARCH_URLS, search_url)
+    await transaction.execute()
+
+
+async def get_launched_searches() -> Dict[str, Set[str]]:
+    """Get all launched searches with ids of their subscribers."""
+    db = await get_database_connection()
+    search_urls = await db.smembers(DB_LAUNCHED_SEARCH_URLS, encoding='utf-8')
+    pipeline = db.pipeline()
+    for search_url in search_urls:
+        pipeline.smembers(f'{DB_SEARCH_SUBSCRIBERS_PREFIX}{search_url}', encoding='utf-8')
+
+    launched_searches = {}
+    abandoned_urls = []
+    for search_url, subscribers in zip(search_urls, await pipeline.execute()):
+        if subscribers:
+            launched_searches[search_url] = set(subscribers)
+        else:
+            abandoned_urls.append(search_url)
+    if abandoned_urls:
+        transaction = db.multi_exec()
+        transaction.srem(DB_LAUNCHED_SEARCH_URLS, *abandoned_urls)
+        transaction.hdel(DB_SEARCH_CHECKED_AT, *abandoned_urls)
+        transaction.hdel(DB_SEARCH_INTERVALS, *abandoned_urls)
+        transaction.hdel(DB_SEARCH_PAGES_DEPTHS, *abandoned_urls)
+        await transaction.execute()
+    return launched_searches
 
-def get_launched_searches() -> Optional[dict]:
-    """Get all launched searches."""
-    db = get_database_connection()
-    raw_launched_searches = db.hgetall(DB_LAUNCHED_SEARCHES)
 
-    launched_searches = {
-        user_id.decode(): set(json.loads(search_urls))
-        for user_id, search_urls in raw_launched_searches.items()
+async def store_search_check(search_url: str, checked_at: float, interval: float):
+    """Store time of the last search check and search polling interval."""
+    db = await get_database_connection()
+    pipeline = db.pipeline()
+    pipeline.hset(DB_SEARCH_CHECKED_AT, search_url, checked_at)
+    pipeline.hset(DB_SEARCH_INTERVALS, search_url, interval)
+    await pipeline.execute()
+
+
+async def get_search_checks(search_urls: List[str]) -> Dict[str, Tuple[float, float]]:
+    """Get time of the last check and polling interval of searches that were checked."""
+    if not search_urls:
+        return dict()
+    db = await get_database_connection()
+    pipeline = db.pipeline()
+    pipeline.hmget(DB_SEARCH_CHECKED_AT, *search_urls)
+    pipeline.hmget(DB_SEARCH_INTERVALS, *search_urls)
+    checked_at_values, intervals = await pipeline.execute()
+    return {
+        search_url: (float(checked_at), float(interval))
+        for search_url, checked_at, interval in zip(search_urls, checked_at_values, intervals)
+        if checked_at and interval
     }
-    return launched_searches
 
 
-def get_user_launched_searches(user_id: str) -> Optional[list]:
-    """Get user launched searches."""
-    db = get_database_connection()
-    raw_searches = db.hget(DB_LAUNCHED_SEARCHES, user_id)
-    if not raw_searches:
-        return None
-    return json.loads(raw_searches)
+async def remove_launched_search(user_id: str, search_url: str):
+    """Remove search url from launched searches."""
+    db = await get_database_connection()
+    await db.srem(f'{DB_SEARCH_SUBSCRIBERS_PREFIX}{search_url}', user_id)
 
 
-def remove_launched_search(user_id: str, search_url: str):
-    """Remove search url from launched searches."""
-    db = get_database_connection()
-    raw_launched_urls = db.hget(DB_LAUNCHED_SEARCHES, user_id)
-    if not raw_launched_urls:
-        error_text = 'Tried to remove search url from empty user launched urls. ' + \
-            f'User id is {user_id}, search url is {search_url}'
-        db_logger.error(error_text)
+async def migrate_launched_searches():
+    """Move launched searches from JSON lists of old hash into sets."""
+    db = await get_database_connection()
+    raw_launched_searches = await db.hgetall(DB_LAUNCHED_SEARCHES)
+    if not raw_launched_searches:
         return
-    launched_urls = json.loads(raw_launched_urls)
-    launched_urls.remove(search_url)
-    if not launched_urls:
-        db.hdel(DB_LAUNCHED_SEARCHES, str(user_id))
+    for user_id, search_urls in raw_launched_searches.items():
+        for search_url in json.loads(search_urls):
+            await add_launched_search(user_id.decode('utf-8'), search_url)
+    await db.delete(DB_LAUNCHED_SEARCHES)
+    db_logger.debug(f'Migrated launched searches of {len(raw_launched_searches)} users')
+
+
+async def migrate_indexes():
+    """Build users and products indexes for data stored before indexes were introduced.
+
+    Products stored before PRODUCT_TTL was introduced get their TTL here too.
+    Old global products index is removed, it isn't kept since version 3.
+
+    Keys are iterated with SCAN, so migration doesn't block db for other clients.
+    """
+    db = await get_database_connection()
+    indexes_version = int(await db.get(DB_INDEXES_VERSION) or 0)
+    if indexes_version >= INDEXES_VERSION:
         return
-    db.hset(DB_LAUNCHED_SEARCHES, str(user_id), json.dumps(launched_urls))
+    if indexes_version < 2:
+        await _build_indexes()
+    await db.delete(DB_PRODUCTS)
+    await db.set(DB_INDEXES_VERSION, INDEXES_VERSION)
+
+
+async def _build_indexes():
+    """Build users and products indexes from stored searches and products."""
+    db = await get_database_connection()
+    db_logger.debug('Starting indexes migration')
+
+    users_amount = 0
+    async for search_key in db.iscan(match=f'{DB_SEARCH_PREFIX}*'):
+        user_id = search_key.decode('utf-8')[len(DB_SEARCH_PREFIX):]
+        await db.sadd(DB_USERS, user_id)
+        users_amount += 1
+
+    product_keys = []
+    products_amount = 0
+    async for product_key in db.iscan(match=f'{DB_PRODUCT_PREFIX}*', count=1000):
+        product_keys.append(product_key)
+        if len(product_keys) >= 1000:
+            await _index_products(product_keys)
+            products_amount += len(product_keys)
+            product_keys = []
+    if product_keys:
+        await _index_products(product_keys)
+        products_amount += len(product_keys)
+    db_logger.debug(f'Indexed {users_amount} users and {products_amount} products')
+
+
+async def _index_products(product_keys: list):
+    """Add products to user and search products indexes and set their TTL."""
+    db = await get_database_connection()
+    pipeline = db.pipeline()
+    for key in product_keys:
+        pipeline.hget(key, 'search_url')
+    search_urls = await pipeline.execute()
+
+    pipeline = db.pipeline()
+    for key, search_url in zip(product_keys, search_urls):
+        user_id = get_product_user_id(key)
+        pipeline.expire(key, PRODUCT_TTL)
+        pipeline.sadd(f'{DB_USER_PRODUCTS_PREFIX}{user_id}', key)
+        if search_url:
+            pipeline.sadd(
+                f'{DB_SEARCH_PRODUCTS_PREFIX}{user_id}:{search_url.decode("utf-8")}', key)
+    await pipeline.execute()
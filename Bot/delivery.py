@@ -0,0 +1,116 @@
+"""Telegram messages delivery queue.
+
+Every chat has its own messages queue, chats take turns in delivery queue
+when per chat Telegram rate limit allows their next message. Workers send
+messages within global rate limit and retry them on flood control errors.
+"""
+from asyncio import ensure_future, get_event_loop, Queue, Task
+from collections import deque
+from functools import partial
+from logging import getLogger
+import os
+from time import monotonic
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Union
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import RetryAfter
+
+from limiters import TokenBucket
+
+
+delivery_logger = getLogger('delivery_logger')
+
+TG_MESSAGES_PER_SECOND = float(os.getenv('TG_MESSAGES_PER_SECOND', 25))
+TG_CHAT_MESSAGES_PER_MINUTE = float(os.getenv('TG_CHAT_MESSAGES_PER_MINUTE', 60))
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 5))
+DELIVERY_RETRIES = 3
+
+_queue: Optional[Queue] = None  # ids of chats, which next message can be sent now
+_workers: List[Task] = list()
+_global_bucket = TokenBucket(TG_MESSAGES_PER_SECOND, capacity=TG_MESSAGES_PER_SECOND)
+_chat_messages: Dict[str, Deque[list]] = dict()  # chat id: [send, result, attempt] messages
+_chat_ready_at: Dict[str, float] = dict()
+
+
+async def send_photo(bot: Bot, chat_id: Union[int, str], photo: str,
+                     caption: str) -> types.Message:
+    """Put photo message into delivery queue and wait until it's sent."""
+    return await deliver(chat_id, partial(bot.send_photo, chat_id, photo, caption=caption))
+
+
+async def deliver(chat_id: Union[int, str], send: Callable[[], Awaitable]) -> Any:
+    """Put send call into chat delivery queue and wait for its result.
+
+    Exceptions raised by send are raised here.
+    """
+    global _queue
+    if _queue is None:
+        _queue = Queue()
+        for _ in range(DELIVERY_WORKERS):
+            _workers.append(ensure_future(_run_delivery_worker(_queue)))
+
+    result = get_event_loop().create_future()
+    chat_messages = _chat_messages.setdefault(str(chat_id), deque())
+    chat_messages.append([send, result, 0])
+    if len(chat_messages) == 1:  # Otherwise chat is already queued or waits for its turn
+        _queue_chat(str(chat_id))
+    return await result
+
+
+def _queue_chat(chat_id: str):
+    """Put chat into delivery queue when its per chat rate limit allows next message.
+
+    Chat waits for its turn outside of the queue, so workers aren't blocked
+    by chats with a lot of messages and other chats get their messages in time.
+    """
+    delay = _chat_ready_at.get(chat_id, 0) - monotonic()
+    if delay > 0:
+        get_event_loop().call_later(delay, _queue.put_nowait, chat_id)  # type: ignore
+    else:
+        _queue.put_nowait(chat_id)  # type: ignore
+
+
+async def _run_delivery_worker(queue: Queue):
+    """Send next messages of chats from delivery queue."""
+    while True:
+        chat_id = await queue.get()
+        try:
+            await _send_next_message(chat_id)
+        except Exception:
+            delivery_logger.exception(f'Failed to deliver message to chat {chat_id}')
+        finally:
+            queue.task_done()
+
+
+async def _send_next_message(chat_id: str):
+    """Send the first message of chat within global rate limit, retry if Telegram asks to."""
+    chat_messages = _chat_messages[chat_id]
+    message = chat_messages[0]
+    send, result, attempt = message
+    if not result.cancelled():
+        await _global_bucket.acquire()
+        try:
+            response = await send()
+        except RetryAfter as e:
+            if attempt < DELIVERY_RETRIES - 1:
+                delivery_logger.warning(
+                    f'Got flood control for chat {chat_id}, retry in {e.timeout}')
+                message[2] += 1
+                _chat_ready_at[chat_id] = monotonic() + e.timeout
+                _queue_chat(chat_id)  # Message is left first in chat messages
+                return
+            if not result.done():
+                result.set_exception(e)
+        except Exception as e:
+            if not result.done():
+                result.set_exception(e)
+        else:
+            if not result.done():
+                result.set_result(response)
+        _chat_ready_at[chat_id] = monotonic() + 60 / TG_CHAT_MESSAGES_PER_MINUTE
+
+    chat_messages.popleft()
+    if chat_messages:
+        _queue_chat(chat_id)
+    else:
+        del _chat_messages[chat_id]
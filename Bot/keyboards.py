@@ -9,6 +9,8 @@ exit_admin = InlineKeyboardButton('Выход из админки', callback_dat
 
 users = InlineKeyboardButton('Пользователи', callback_data='users')
 
+scheduler = InlineKeyboardButton('Планировщик', callback_data='scheduler')
+
 
 def get_pagination_button(direction: str, callback_data: str) -> InlineKeyboardButton:
     """Get pagination button.
@@ -31,5 +33,6 @@ def collect_admin_panel_keyboard():
     keyboard = InlineKeyboardMarkup()
     keyboard.insert(db)
     keyboard.insert(users)
+    keyboard.insert(scheduler)
     keyboard.add(exit_admin)
     return keyboard
@@ -0,0 +1,45 @@
+"""Shared startup of tg bot and parser worker processes.
+
+.env is loaded on import, so start scripts import launcher before other
+project modules, they read their settings from env on import.
+"""
+from asyncio import AbstractEventLoop
+import logging
+import os
+from typing import Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db_aps import migrate_indexes, migrate_launched_searches  # noqa: E402
+
+
+avito_logger = logging.getLogger('avito_loger')
+
+
+def is_env_enabled(name: str) -> bool:
+    """Check boolean env setting, like DEBUG=true."""
+    return os.getenv(name, 'False').lower() in ['true', 'yes', 'y', '1']
+
+
+def prepare_parser(loop: AbstractEventLoop, process_name: str) -> Tuple[int, int]:
+    """Configure logging, migrate db and get parser and expired collector sleep times.
+
+    In DEBUG mode everything is logged, searches and collector are run often.
+    """
+    if is_env_enabled('DEBUG'):
+        parser_sleep_time = 10
+        collector_sleep_time = 20
+        logging.basicConfig(
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            level='DEBUG'
+        )
+        avito_logger.debug(f'Starting {process_name} in debug mode')
+    else:
+        parser_sleep_time = int(os.getenv('SEARCH_RECONCILE_INTERVAL', 3600))
+        collector_sleep_time = 43200  # 12 hours
+        avito_logger.debug(f'Starting {process_name}')
+    loop.run_until_complete(migrate_indexes())
+    loop.run_until_complete(migrate_launched_searches())
+    return parser_sleep_time, collector_sleep_time
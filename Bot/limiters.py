@@ -0,0 +1,75 @@
+"""Rate limiters of outbound requests.
+
+Every (host, budget) pair has its own token bucket and concurrency limit,
+so all searches, image and expiry checks share one request budget per host.
+"""
+from asyncio import Lock, Semaphore, sleep
+from contextlib import asynccontextmanager
+from logging import getLogger
+import os
+from time import monotonic
+from typing import AsyncIterator, Dict, Tuple
+from urllib.parse import urlsplit
+
+
+limiters_logger = getLogger('limiters_logger')
+
+REQUEST_BUDGETS = {  # budget: (requests per minute, concurrent requests)
+    'search': (
+        float(os.getenv('SEARCH_REQUESTS_PER_MINUTE', 20)),
+        int(os.getenv('SEARCH_REQUESTS_CONCURRENCY', 5)),
+    ),
+    'product': (
+        float(os.getenv('PRODUCT_REQUESTS_PER_MINUTE', 30)),
+        int(os.getenv('PRODUCT_REQUESTS_CONCURRENCY', 5)),
+    ),
+}
+
+_request_budgets: Dict[Tuple[str, str], 'RequestBudget'] = dict()
+
+
+class TokenBucket:
+    """Token bucket rate limiter, waiters get tokens in FIFO order."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Wait for token and take it."""
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class RequestBudget:
+    """Requests rate and concurrency limits of one host."""
+
+    def __init__(self, requests_per_minute: float, concurrency: int):
+        self.bucket = TokenBucket(requests_per_minute / 60)
+        self.semaphore = Semaphore(concurrency)
+
+
+@asynccontextmanager
+async def request_budget(url: str, budget: str = 'search') -> AsyncIterator[None]:
+    """Wait until request to url fits into host budget and hold request slot."""
+    host = urlsplit(url).hostname or ''
+    request_budget = _request_budgets.get((host, budget))
+    if not request_budget:
+        request_budget = RequestBudget(*REQUEST_BUDGETS[budget])
+        _request_budgets[(host, budget)] = request_budget
+
+    async with request_budget.semaphore:
+        await request_budget.bucket.acquire()
+        yield
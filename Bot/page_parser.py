@@ -0,0 +1,268 @@
+"""Fast Avito pages parsing with embedded JSON state or lxml and precompiled XPath expressions.
+
+Functions take raw page bytes and return plain python objects,
+so search pages are parsed without building BeautifulSoup tree
+and parsing can be run in process pool (see run_parser).
+"""
+from asyncio import get_event_loop
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+import json
+from logging import getLogger
+import os
+from typing import Any, Callable, Dict, List, Mapping, Optional, TypeVar
+from urllib.parse import unquote
+
+from lxml import etree
+
+
+page_parser_logger = getLogger('page_parser_logger')
+
+PARSER_PROCESSES = int(os.getenv('PARSER_PROCESSES', 0))  # 0 parses in event loop thread
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+ParseResult = TypeVar('ParseResult')
+
+
+def _has_class(class_name: str) -> str:
+    """Get XPath predicate matching element with css class."""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+
+HTML_PARSER = etree.HTMLParser(encoding='utf-8', remove_comments=True)
+INITIAL_STATE_MARKER = b'window.__initialData__'
+AVITO_TIMEZONE = timezone(timedelta(hours=3))  # Moscow
+
+PRODUCTS_XPATH = etree.XPath(f'//*[{_has_class("item_table")}]')
+EXTRA_BLOCKS_XPATH = etree.XPath(f'//*[{_has_class("extra-block__title")}]')
+# String XPath results are plain str (smart_strings=False), they don't keep tree alive
+EXTRA_BLOCK_COUNT_XPATH = etree.XPath(
+    f'string((.//*[{_has_class("extra-block__count")}])[1])', smart_strings=False)
+PRODUCT_ID_XPATH = etree.XPath('string(@data-item-id)', smart_strings=False)
+TITLE_XPATH = etree.XPath(
+    f'string((.//*[{_has_class("snippet-link")}])[1]/@title)', smart_strings=False)
+PRICE_XPATH = etree.XPath(
+    f'string((.//*[{_has_class("snippet-price")}])[1])', smart_strings=False)
+HREF_XPATH = etree.XPath(
+    f'string((.//*[{_has_class("snippet-link")}])[1]/@href)', smart_strings=False)
+PUB_DATE_XPATH = etree.XPath(
+    f'string((.//*[{_has_class("snippet-date-info")}])[1]/@data-tooltip)', smart_strings=False)
+IMG_XPATH = etree.XPath('(.//img)[1]')
+PRODUCT_IMG_URL_XPATH = etree.XPath(
+    f'string((//*[{_has_class("gallery-img-frame")} or '
+    f'{_has_class("image-frame-wrapper-2FMhm")}])[1]/@data-url)',
+    smart_strings=False,
+)
+
+
+async def run_parser(parse: Callable[[bytes], ParseResult], page: bytes) -> ParseResult:
+    """Run parse function on page in process pool of PARSER_PROCESSES size.
+
+    parse should be module level function, so it can be pickled.
+    Without PARSER_PROCESSES page is parsed right in event loop thread.
+    """
+    global _executor
+    if not PARSER_PROCESSES:
+        return parse(page)
+    if _executor is None:
+        _executor = ProcessPoolExecutor(PARSER_PROCESSES)
+        page_parser_logger.debug(f'Started parser pool of {PARSER_PROCESSES} processes')
+    try:
+        return await get_event_loop().run_in_executor(_executor, parse, page)
+    except BrokenProcessPool:
+        _executor = None  # Pool with killed process is unusable, new one is started next time
+        raise
+
+
+def parse_search_page_json(page: bytes) -> List[dict]:
+    """Parse product infos from embedded JSON state, CSS selectors are used if there is no state."""
+    try:
+        product_infos = parse_search_page_state(page)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:  # Unexpected state schema
+        page_parser_logger.warning(f'Failed to parse initial state: {e!r}')
+        product_infos = None
+    if product_infos is None:
+        page_parser_logger.debug('Search page has no initial state, parse it with CSS selectors')
+        return parse_search_page(page)
+    return product_infos
+
+
+def parse_search_page_state(page: bytes) -> Optional[List[dict]]:
+    """Parse product infos from embedded JSON state, None if page has no catalog state.
+
+    Items of extra block (offers from other cities) are kept apart in state, so they are skipped.
+    Missing or empty id, title, price or link raise KeyError or ValueError, so that page
+    is parsed with CSS selectors instead of sending products with blank fields.
+    pub_date is formatted from item timestamp like '13.09.2020 15:26', unlike
+    '12 октября 16:18' tooltip text of search page markup.
+    """
+    initial_state = get_initial_state(page)
+    catalog = find_catalog_state(initial_state) if initial_state else None
+    if catalog is None:
+        return None
+
+    product_infos = []
+    for item in catalog['items']:
+        if item.get('type', 'item') != 'item':  # Ads and banners
+            continue
+        pub_date = ''
+        if item.get('sortTimeStamp'):
+            pub_date = datetime.fromtimestamp(
+                item['sortTimeStamp'] / 1000, AVITO_TIMEZONE).strftime('%d.%m.%Y %H:%M')
+        product_infos.append({
+            'product_id': str(_get_required(item, 'id')),
+            'title': _get_required(item, 'title'),
+            'price': ' '.join(str(_get_required(item, 'priceDetailed', 'string')).split()),
+            'product_url': 'https://www.avito.ru{}'.format(_get_required(item, 'urlPath')),
+            'pub_date': pub_date,
+            'img_url': select_state_img_url(item.get('images') or []),
+        })
+    page_parser_logger.debug(f'Parsed {len(product_infos)} products from initial state')
+    return product_infos
+
+
+def _get_required(item: Dict[str, Any], *keys: str) -> Any:
+    """Get nested item field, KeyError or ValueError is raised if it's missing or empty."""
+    value = item
+    for key in keys:
+        value = value[key]
+    if value in (None, ''):
+        raise ValueError(f'Item {item.get("id")!r} has empty {".".join(keys)}')
+    return value
+
+
+def get_initial_state(page: bytes) -> Optional[Dict[str, Any]]:
+    """Slice initial state JSON out of raw page bytes without parsing html.
+
+    State is assigned either as url encoded JSON string or as object literal,
+    None is returned if there is no state assignment or state isn't an object.
+    """
+    start = _find_state_assignment(page)
+    if start is None:
+        return None
+    if page[start:start + 1] == b'"':  # Url encoded string has no quotes inside
+        end = page.find(b'"', start + 1)
+        if end == -1:
+            return None
+        initial_state = json.loads(unquote(page[start + 1:end].decode('utf-8')))
+    else:
+        end = page.find(b'</script>', start)
+        if end == -1:
+            return None
+        initial_state = json.loads(page[start:end].rstrip().rstrip(b';'))
+    return initial_state if isinstance(initial_state, dict) else None
+
+
+def _find_state_assignment(page: bytes) -> Optional[int]:
+    """Find start of value assigned to initial state, other marker usages are skipped."""
+    marker_index = page.find(INITIAL_STATE_MARKER)
+    while marker_index != -1:
+        index = marker_index + len(INITIAL_STATE_MARKER)
+        while page[index:index + 1].isspace():
+            index += 1
+        if page[index:index + 1] == b'=' and page[index + 1:index + 2] != b'=':
+            index += 1
+            while page[index:index + 1].isspace():
+                index += 1
+            return index
+        marker_index = page.find(INITIAL_STATE_MARKER, index)
+    return None
+
+
+def find_catalog_state(initial_state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Find catalog with items in state, it's kept in state of one of page modules."""
+    for module_state in initial_state.values():
+        if not isinstance(module_state, dict):
+            continue
+        module_data = module_state.get('data', module_state)
+        if isinstance(module_data, dict) and isinstance(module_data.get('catalog'), dict):
+            if 'items' in module_data['catalog']:
+                return module_data['catalog']
+    return None
+
+
+def select_state_img_url(images: List[Dict[str, str]]) -> Optional[str]:
+    """Select the biggest url of the first image, images are dicts like {'208x156': url}."""
+    sizes = []
+    for size, img_url in (images[0] if images else {}).items():
+        width, _, height = size.partition('x')
+        if width.isdigit() and height.isdigit() and str(img_url).startswith('http'):
+            sizes.append((int(width) * int(height), img_url))
+    return max(sizes)[1] if sizes else None
+
+
+def parse_search_page(page: bytes) -> List[dict]:
+    """Parse product infos from search page, offers from other cities are removed.
+
+    Dict keys are the same as in avito_parser.parse_product_infos:
+    product_id, title, price, product_url, pub_date, img_url
+    """
+    tree = etree.fromstring(page, HTML_PARSER)
+    if tree is None:
+        page_parser_logger.warning('Got empty search page')
+        return []
+    products = PRODUCTS_XPATH(tree)
+
+    extra_blocks = EXTRA_BLOCKS_XPATH(tree)
+    if len(extra_blocks) > 1:  # Expected only one extra block
+        page_parser_logger.warning(f'Got {len(extra_blocks)} extra blocks')
+    extra_products = 0
+    for block in extra_blocks:
+        products_count = EXTRA_BLOCK_COUNT_XPATH(block)
+        if products_count:
+            extra_products += int(products_count)
+    if extra_products:
+        products = products[:-extra_products]
+
+    product_infos = []
+    for product in products:
+        product_id = PRODUCT_ID_XPATH(product)
+        href = HREF_XPATH(product)
+        if not product_id or not href:  # Markup was changed, item can't be stored or sent
+            page_parser_logger.warning(f'Skipped product without id or link: {product_id!r}')
+            continue
+        product_info = {
+            'product_id': product_id,
+            'title': TITLE_XPATH(product),
+            'price': PRICE_XPATH(product).strip(),
+            'product_url': 'https://www.avito.ru{}'.format(href),
+            'pub_date': PUB_DATE_XPATH(product),
+            'img_url': None,
+        }
+        thumbnail = IMG_XPATH(product)
+        if thumbnail:
+            product_info['img_url'] = select_img_url(thumbnail[0].attrib)
+        product_infos.append(product_info)
+    page_parser_logger.debug(
+        f'Parsed {len(product_infos)} products (removed {extra_products} extra products)'
+    )
+    return product_infos
+
+
+def parse_product_image_url(page: bytes) -> Optional[str]:
+    """Parse main image url from product page, None if page has no image gallery."""
+    tree = etree.fromstring(page, HTML_PARSER)
+    if tree is None:
+        return None
+    return PRODUCT_IMG_URL_XPATH(tree) or None
+
+
+def select_img_url(img_attributes: Mapping[str, str]) -> Optional[str]:
+    """Select the biggest image url from snippet img tag attributes.
+
+    Lazy loading placeholders (data URIs) are skipped, None is returned if there is no url.
+    """
+    srcset = img_attributes.get('srcset') or img_attributes.get('data-srcset')
+    if srcset:
+        biggest_img = srcset.split(',')[-1].split()
+        if biggest_img and biggest_img[0].startswith('http'):
+            return biggest_img[0]
+    for attribute in ('data-src', 'src'):
+        img_url = img_attributes.get(attribute)
+        if img_url and img_url.startswith('//'):
+            img_url = f'https:{img_url}'
+        if img_url and img_url.startswith('http'):
+            return img_url
+    return None
@@ -58,6 +58,28 @@ exit_admin = 'Admin panel exit'
 
 db_info = 'DB info'
 
+scheduler_page = 'Scheduler, page {page}'
+
+scheduler_queue = 'Поисков в расписании: {amount}, проверяются сейчас: {running}\n\n'
+
+scheduler_in_workers = '''\
+Поиски проверяют воркеры (BOT_ONLY), у каждого своя очередь в его процессе.
+Здесь она не видна, смотри логи воркеров
+'''
+
+scheduler_search = '''\
+{search_url}
+Интервал: {interval} сек, следующая проверка через {due_in} сек
+Проверок: {checks}, с изменениями: {changes}\n
+'''
+
+pages_depth_usage = '''\
+Отправь /pages_depth <ссылка поиска> <количество страниц>,
+0 страниц возвращает значение по умолчанию
+'''
+
+pages_depth_set = 'Для поиска {search_url} проверяется страниц: {pages_depth}'
+
 users = 'Всего пользователей: {amount}. Выбери одного:'
 
 users_page = 'Users, page {page}'
@@ -0,0 +1,224 @@
+"""Searches scheduler.
+
+Scheduler keeps priority queue of due searches, runs their checks
+with limited concurrency and adapts polling interval of every search
+to the rate of its changes: hot searches are polled often, dead ones rarely.
+"""
+from asyncio import (CancelledError, ensure_future, Event, Future, Semaphore, Task, TimeoutError,
+                     wait_for)
+from functools import partial
+from heapq import heappop, heappush
+from logging import getLogger
+import os
+from random import uniform
+from time import monotonic, time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+scheduler_logger = getLogger('scheduler_logger')
+
+SEARCH_MIN_INTERVAL = int(os.getenv('SEARCH_MIN_INTERVAL', 600))
+SEARCH_MAX_INTERVAL = int(os.getenv('SEARCH_MAX_INTERVAL', 14400))  # 4 hours
+SEARCH_DEFAULT_INTERVAL = int(os.getenv('SEARCH_DEFAULT_INTERVAL', 1800))
+SCHEDULER_CONCURRENCY = int(os.getenv('SCHEDULER_CONCURRENCY', 5))
+WARM_START_WINDOW = int(os.getenv('WARM_START_WINDOW', 600))
+
+_queue: List[Tuple[float, str]] = list()  # heap of (due time, search url)
+_schedules: Dict[str, 'SearchSchedule'] = dict()
+_running_checks: Dict[str, Task] = dict()
+_queue_updated = Event()
+_is_started = False
+
+StoreCheck = Callable[[str, float, float], Awaitable]
+
+
+class SearchSchedule:
+    """Polling schedule of search."""
+
+    def __init__(self, search_url: str, interval: float = SEARCH_DEFAULT_INTERVAL):
+        self.search_url = search_url
+        self.interval = interval
+        self.due = 0.0
+        self.checks = 0
+        self.changes = 0
+
+    def register_check(self, has_changes: bool):
+        """Count search check and adapt polling interval to it."""
+        self.checks += 1
+        if has_changes:
+            self.changes += 1
+            interval = self.interval / 2
+        else:
+            interval = self.interval * 1.5
+        self.interval = min(max(interval, SEARCH_MIN_INTERVAL), SEARCH_MAX_INTERVAL)
+
+
+def schedule_search(search_url: str, delay: float = 0,
+                    interval: float = SEARCH_DEFAULT_INTERVAL):
+    """Add search to the queue, searches which are already scheduled are skipped."""
+    if search_url in _schedules:
+        return
+    schedule = SearchSchedule(search_url, interval)
+    _schedules[search_url] = schedule
+    _push(schedule, monotonic() + delay)
+    scheduler_logger.debug(f'Scheduled search {search_url} in {delay} sec')
+
+
+def plan_warm_start(search_urls: Iterable[str], search_checks: Dict[str, Tuple[float, float]],
+                    window: float = WARM_START_WINDOW):
+    """Schedule searches after restart without burst of simultaneous checks.
+
+    search_checks holds (last check time, interval) of searches checked before restart.
+    Searches which are not due yet resume their schedule, due and never checked
+    searches are spread evenly over window, the most overdue go first.
+    """
+    now = time()
+    overdue_searches = list()
+    for search_url in search_urls:
+        if search_url not in search_checks:
+            overdue_searches.append((0.0, search_url))
+            continue
+        checked_at, interval = search_checks[search_url]
+        due = checked_at + interval
+        if due > now:
+            schedule_search(search_url, due - now, interval)
+        else:
+            overdue_searches.append((due, search_url))
+
+    overdue_searches.sort()
+    step = window / len(overdue_searches) if overdue_searches else 0
+    for number, (_, search_url) in enumerate(overdue_searches):
+        interval = search_checks.get(search_url, (0, SEARCH_DEFAULT_INTERVAL))[1]
+        schedule_search(search_url, number * step, interval)
+    scheduler_logger.debug(
+        f'Warm start: {len(overdue_searches)} due searches spread over {window} sec')
+
+
+def reschedule_search(search_url: str, delay: float = 0):
+    """Move check of search to delay sec from now, unscheduled search is scheduled."""
+    schedule = _schedules.get(search_url)
+    if not schedule:
+        schedule_search(search_url, delay)
+    elif search_url not in _running_checks:
+        _push(schedule, monotonic() + delay)
+        scheduler_logger.debug(f'Rescheduled search {search_url} in {delay} sec')
+
+
+def unschedule_search(search_url: str):
+    """Remove search from schedule and cancel its running check."""
+    _schedules.pop(search_url, None)
+    check = _running_checks.get(search_url)
+    if check:
+        check.cancel()
+    scheduler_logger.debug(f'Search {search_url} removed from schedule')
+
+
+def is_scheduled(search_url: str) -> bool:
+    """Check that search is in schedule."""
+    return search_url in _schedules
+
+
+def _push(schedule: SearchSchedule, due: float):
+    schedule.due = due
+    heappush(_queue, (due, schedule.search_url))
+    _queue_updated.set()
+
+
+async def run_scheduler(check_search: Callable[[str], Awaitable[Optional[bool]]],
+                        store_check: Optional[StoreCheck] = None,
+                        concurrency: int = SCHEDULER_CONCURRENCY):
+    """Run checks of due searches, no more than concurrency checks at once.
+
+    check_search should return True if search has changes, False if it hasn't
+    and None if search should be removed from schedule.
+    store_check is called with search url, check time and new interval after every check,
+    so that schedule can be restored after restart with plan_warm_start.
+    """
+    global _is_started
+    _is_started = True
+    semaphore = Semaphore(concurrency)
+    while True:
+        await semaphore.acquire()
+        search_url = await _wait_due_search()
+        check = ensure_future(_run_check(check_search, search_url, store_check))
+        # Done callback is called even if check was cancelled before it started
+        check.add_done_callback(partial(_finish_check, search_url, semaphore))
+        _running_checks[search_url] = check
+
+
+async def _wait_due_search() -> str:
+    """Wait for the nearest due search and pop it from the queue."""
+    while True:
+        _queue_updated.clear()
+        while _queue:
+            due, search_url = _queue[0]
+            schedule = _schedules.get(search_url)
+            if schedule and schedule.due == due:
+                break
+            heappop(_queue)  # Search was removed or rescheduled
+        now = monotonic()
+        if _queue and _queue[0][0] <= now:
+            return heappop(_queue)[1]
+
+        timeout = _queue[0][0] - now if _queue else None
+        try:
+            await wait_for(_queue_updated.wait(), timeout)
+        except TimeoutError:
+            pass
+
+
+async def _run_check(check_search: Callable[[str], Awaitable[Optional[bool]]],
+                     search_url: str, store_check: Optional[StoreCheck] = None):
+    """Run search check and put search back to the queue with adapted interval."""
+    has_changes: Optional[bool] = False
+    try:
+        has_changes = await check_search(search_url)
+    except CancelledError:
+        scheduler_logger.debug(f'Search check cancelled: {search_url}')
+        raise
+    except Exception:
+        scheduler_logger.exception(f'Search check failed: {search_url}')
+
+    schedule = _schedules.get(search_url)
+    if not schedule:
+        return
+    if has_changes is None:
+        del _schedules[search_url]
+        scheduler_logger.debug(f'Search {search_url} removed from schedule')
+        return
+    schedule.register_check(has_changes)
+    # Jitter prevents searches with equal intervals from being checked at once
+    _push(schedule, monotonic() + schedule.interval * uniform(0.9, 1.1))
+    if store_check:
+        try:
+            await store_check(search_url, time(), schedule.interval)
+        except Exception:
+            scheduler_logger.exception(f'Failed to store check of search {search_url}')
+
+
+def _finish_check(search_url: str, semaphore: Semaphore, check: Future):
+    semaphore.release()
+    if _running_checks.get(search_url) is check:
+        del _running_checks[search_url]
+
+
+def is_started() -> bool:
+    """Check that scheduler runs in this process, with BOT_ONLY searches are run by workers."""
+    return _is_started
+
+
+def get_scheduler_state() -> List[dict]:
+    """Get scheduled searches ordered by due time."""
+    now = monotonic()
+    state = [
+        {
+            'search_url': schedule.search_url,
+            'interval': round(schedule.interval),
+            'due_in': max(round(schedule.due - now), 0),
+            'is_running': schedule.search_url in _running_checks,
+            'checks': schedule.checks,
+            'changes': schedule.changes,
+        }
+        for schedule in _schedules.values()
+    ]
+    return sorted(state, key=lambda search_state: search_state['due_in'])
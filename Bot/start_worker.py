@@ -0,0 +1,41 @@
+import logging
+import os
+
+from aiogram import Bot
+
+import launcher  # Loads .env
+from avito_parser import start_parser
+from db_aps import start_expired_products_collector
+import workers
+
+
+avito_logger = logging.getLogger('avito_loger')
+
+
+def main():
+    start_worker()
+
+
+def start_worker():
+    """Start parser and expired_collector without tg bot polling.
+
+    Any number of workers can be started, searches are shared between them.
+    """
+    bot = Bot(token=os.environ['TG_BOT_TOKEN'], proxy=os.environ.get('TG_PROXY'))
+    loop = bot.loop
+    parser_sleep_time, collector_sleep_time = launcher.prepare_parser(
+        loop, f'parser worker {workers.WORKER_ID}')
+    loop.create_task(start_parser(bot, parser_sleep_time))
+    loop.create_task(start_expired_products_collector(collector_sleep_time, workers.WORKER_ID))
+    try:
+        loop.run_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        loop.run_until_complete(workers.leave())
+        loop.run_until_complete(bot.close())
+    avito_logger.debug('Parser worker stopped working')
+
+
+if __name__ == '__main__':
+    main()
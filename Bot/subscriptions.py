@@ -0,0 +1,50 @@
+"""In-process registry of launched searches.
+
+Registry maps search url to ids of subscribed users, so the parser
+gets subscribers of a search without db queries. Launched searches
+are mirrored to db (see db_aps.add_launched_search) to restore them after restart.
+"""
+from typing import Dict, List, Set, Tuple
+
+
+_subscribers: Dict[str, Set[str]] = dict()
+
+
+def add_subscription(user_id: str, search_url: str) -> bool:
+    """Subscribe user to search. Returns True if subscription is new."""
+    search_subscribers = _subscribers.setdefault(search_url, set())
+    if user_id in search_subscribers:
+        return False
+    search_subscribers.add(user_id)
+    return True
+
+
+def remove_subscription(user_id: str, search_url: str) -> bool:
+    """Unsubscribe user from search. Returns True if search has no subscribers left."""
+    search_subscribers = _subscribers.get(search_url)
+    if search_subscribers is None:
+        return True
+    search_subscribers.discard(user_id)
+    if search_subscribers:
+        return False
+    del _subscribers[search_url]
+    return True
+
+
+def get_subscribers(search_url: str) -> Set[str]:
+    """Get ids of users subscribed to search."""
+    return set(_subscribers.get(search_url, ()))
+
+
+def get_search_urls() -> List[str]:
+    """Get urls of searches with subscribers."""
+    return list(_subscribers)
+
+
+def get_subscriptions() -> Set[Tuple[str, str]]:
+    """Get all (user_id, search_url) subscription pairs."""
+    return {
+        (user_id, search_url)
+        for search_url, search_subscribers in _subscribers.items()
+        for user_id in search_subscribers
+    }
@@ -7,16 +7,14 @@ from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils.exceptions import BotBlocked
-from dotenv import load_dotenv
 
 import db_aps
 import keyboards
 import phrases
+import scheduler
 import utils
 
 
-load_dotenv()
-
 bot_logger = getLogger('avito_bot_logger')
 
 # bot settings
@@ -27,9 +25,12 @@ dispatcher = Dispatcher(
     storage=RedisStorage2(
         host=os.environ['DB_HOST'],
         port=os.environ['DB_PORT'],
-        password=os.environ['DB_PASSWORD']
+        password=os.environ['DB_PASSWORD'],
+        pool_size=db_aps.DB_POOL_SIZE,
     ),
 )
+db_aps.share_storage_pool(dispatcher.storage)
+super_admin_id = bot.loop.run_until_complete(db_aps.get_super_admin())
 
 
 class AddSearch(StatesGroup):
@@ -98,7 +99,7 @@ async def start_search_adding(message: types.Message):
     """Start search adding conversation."""
     not_paid_search_limit = 2
 
-    if message.chat.id in db_aps.get_admins():
+    if message.chat.id in await db_aps.get_admins():
         await AddSearch.waiting_url.set()
         await message.answer(phrases.waiting_url, disable_web_page_preview=True)
         bot_logger.debug(f'Start adding new search for {message.chat.id}')
@@ -108,7 +109,7 @@ async def start_search_adding(message: types.Message):
     # user_limit = get_user_search_limit(message.chat.id)
     # ... and len(exist) == user_limit
     # and change text new_search_not_allowed
-    existing_searches = db_aps.get_user_existing_searches(message.chat.id)
+    existing_searches = await db_aps.get_user_existing_searches(message.chat.id)
     if existing_searches and len(existing_searches) == not_paid_search_limit:
         text = phrases.new_search_not_allowed.format(limit=not_paid_search_limit)
         debug_text = f'New search wasn\'t allowed to user {message.chat.id}. \
@@ -130,13 +131,13 @@ async def add_search_url_to_db(message: types.Message, state: FSMContext):
         bot_logger.debug(f'Got wrong url: {message.text} from {message.chat.id}')
         return
 
-    existing_searches = db_aps.get_user_existing_searches(message.chat.id)
+    existing_searches = await db_aps.get_user_existing_searches(message.chat.id)
     if existing_searches and message.text in existing_searches.values():
         await message.answer(phrases.search_already_exists)
         bot_logger.debug(f'Got existing url: {message.text} from {message.chat.id}')
         return
 
-    db_aps.add_new_search(user_id=message.chat.id, url=message.text)
+    await db_aps.add_new_search(user_id=message.chat.id, url=message.text)
     await state.finish()
     await message.answer(phrases.search_added)
     bot_logger.debug(f'New search url for {message.chat.id} added: {message.text}')
@@ -145,7 +146,7 @@ async def add_search_url_to_db(message: types.Message, state: FSMContext):
 @dispatcher.message_handler(state='*', commands=['del_search'])
 async def start_search_deletion(message: types.Message):
     """Start search deletion conversation."""
-    exisiting_searches = db_aps.get_user_existing_searches(message.chat.id)
+    exisiting_searches = await db_aps.get_user_existing_searches(message.chat.id)
     if not exisiting_searches:
         await message.answer(phrases.no_searches_found)
         bot_logger.debug(f'Got delete request from user ({message.chat.id}) with no searches')
@@ -176,20 +177,20 @@ async def delete_search(message: types.Message, state: FSMContext):
         )
         return
 
-    if search_number > len(db_aps.get_user_existing_searches(message.chat.id)):
+    if search_number > len(await db_aps.get_user_existing_searches(message.chat.id)):
         await message.answer(phrases.wrong_number)
         bot_logger.debug(
             f'Got out of range deletion search number ({search_number}) from {message.chat.id}'
         )
         return
 
-    db_aps.remove_search(user_id=message.chat.id, search_number=message.text)
+    await db_aps.remove_search(user_id=message.chat.id, search_number=message.text)
     await state.finish()
     await message.answer(phrases.search_deleted, reply_markup=types.ReplyKeyboardRemove())
     bot_logger.debug(f'Search deleted for {message.chat.id}')
 
 
-@dispatcher.message_handler(chat_id=db_aps.get_super_admin(),
+@dispatcher.message_handler(chat_id=super_admin_id,
                             state='*', commands=['admin'])
 async def show_admin_panel(message: types.Message):
     """Show admin panel to super admin only."""
@@ -200,7 +201,7 @@ async def show_admin_panel(message: types.Message):
 
 @dispatcher.callback_query_handler(
     lambda callback: callback.data == keyboards.exit_admin.callback_data,
-    chat_id=db_aps.get_super_admin(),
+    chat_id=super_admin_id,
     state=AdminPanel.waiting_admin_command)
 async def handle_admin_exit(callback: types.CallbackQuery, state: FSMContext):
     """Handle admin panel exit."""
@@ -211,11 +212,11 @@ async def handle_admin_exit(callback: types.CallbackQuery, state: FSMContext):
 
 @dispatcher.callback_query_handler(
     lambda callback: callback.data == keyboards.db.callback_data,
-    chat_id=db_aps.get_super_admin(),
+    chat_id=super_admin_id,
     state=AdminPanel.waiting_admin_command)
 async def handle_admin_db_info(callback: types.CallbackQuery):
     """Handle admin panel db command and show db info."""
-    db_info = db_aps.get_useful_db_info()
+    db_info = await db_aps.get_useful_db_info()
     text = ''
     for key, value in db_info.items():
         text += f'{key}: {value}\n'
@@ -231,9 +232,69 @@ async def handle_admin_db_info(callback: types.CallbackQuery):
                                      parse_mode=types.ParseMode.MARKDOWN_V2)
 
 
+@dispatcher.callback_query_handler(
+    lambda callback: keyboards.scheduler.callback_data in callback.data,
+    chat_id=super_admin_id,
+    state=AdminPanel.waiting_admin_command)
+async def handle_admin_scheduler_info(callback: types.CallbackQuery):
+    """Handle admin panel scheduler command and show searches queue state with pagination."""
+    scheduler_callback = keyboards.scheduler.callback_data
+    # Page of 10 searches with urls cut to 200 chars fits into 4096 chars of message
+    searches_on_page = 10
+    url_max_length = 200
+
+    if callback.data == scheduler_callback:
+        page = 0
+    else:
+        # cb.data == scheduler:1, where 1 - is page (starts from 0)
+        page = int(callback.data[len(scheduler_callback)+1:])
+    first_search_number = page * searches_on_page
+    next_page_search_number = first_search_number + searches_on_page
+
+    keyboard = types.InlineKeyboardMarkup()
+    if scheduler.is_started():
+        scheduler_state = scheduler.get_scheduler_state()
+        running_searches = [search for search in scheduler_state if search['is_running']]
+        text = phrases.scheduler_queue.format(amount=len(scheduler_state),
+                                              running=len(running_searches))
+        for search_state in scheduler_state[first_search_number:next_page_search_number]:
+            search_url = search_state['search_url']
+            if len(search_url) > url_max_length:
+                search_url = search_url[:url_max_length - 1] + '…'
+            text += phrases.scheduler_search.format(**dict(search_state, search_url=search_url))
+
+        if page != 0:
+            keyboard.add(keyboards.get_pagination_button('previous', f'scheduler:{page-1}'))
+        if next_page_search_number < len(scheduler_state):
+            keyboard.insert(keyboards.get_pagination_button('next', f'scheduler:{page+1}'))
+    else:
+        text = phrases.scheduler_in_workers
+    keyboard.add(keyboards.admin_panel)
+    keyboard.add(keyboards.exit_admin)
+
+    await callback.answer(phrases.scheduler_page.format(page=page + 1))
+    await callback.message.edit_text(text, reply_markup=keyboard, disable_web_page_preview=True)
+
+
+@dispatcher.message_handler(chat_id=super_admin_id, state='*', commands=['pages_depth'])
+async def set_search_pages_depth(message: types.Message):
+    """Set amount of search pages to crawl, /pages_depth <search url> <pages depth>."""
+    arguments = message.get_args().split()
+    if len(arguments) != 2 or not arguments[1].isdigit():
+        await message.answer(phrases.pages_depth_usage)
+        return
+
+    search_url, pages_depth = arguments[0], int(arguments[1])
+    await db_aps.set_search_pages_depth(search_url, pages_depth or None)
+    text = phrases.pages_depth_set.format(
+        search_url=search_url, pages_depth=await db_aps.get_search_pages_depth(search_url))
+    await message.answer(text, disable_web_page_preview=True)
+    bot_logger.debug(f'Set pages depth of {search_url}: {pages_depth}')
+
+
 @dispatcher.callback_query_handler(
     lambda callback: callback.data == keyboards.admin_panel.callback_data,
-    chat_id=db_aps.get_super_admin(),
+    chat_id=super_admin_id,
     state=AdminPanel.waiting_admin_command)
 async def handle_admin_panel(callback: types.CallbackQuery, state: FSMContext):
     """Handle admin_panel command and show admin panel."""
@@ -244,7 +305,7 @@ async def handle_admin_panel(callback: types.CallbackQuery, state: FSMContext):
 
 @dispatcher.callback_query_handler(
     lambda callback: keyboards.users.callback_data in callback.data,
-    chat_id=db_aps.get_super_admin(),
+    chat_id=super_admin_id,
     state=AdminPanel.waiting_admin_command)
 async def handle_admin_users(callback: types.CallbackQuery):
     """Handle users command and show users list with paginationg."""
@@ -260,7 +321,7 @@ async def handle_admin_users(callback: types.CallbackQuery):
     first_user_number = page * users_on_page
     next_page_user_number = first_user_number + users_on_page
 
-    user_ids = db_aps.get_users()
+    user_ids = await db_aps.get_users()
     users_amount = len(user_ids)
     text = phrases.users.format(amount=users_amount)
     keyboard = types.InlineKeyboardMarkup()
@@ -286,7 +347,7 @@ async def handle_admin_users(callback: types.CallbackQuery):
 
 @dispatcher.callback_query_handler(
     lambda callback: 'user_id' in callback.data,
-    chat_id=db_aps.get_super_admin(),
+    chat_id=super_admin_id,
     state=AdminPanel.waiting_admin_command)
 async def handle_admin_user_id(callback: types.CallbackQuery):
     """Handle user_id command and show user info."""
@@ -298,8 +359,8 @@ async def handle_admin_user_id(callback: types.CallbackQuery):
         await callback.answer('BotBlocked')
         return
 
-    searches = db_aps.get_user_existing_searches(user_id)
-    products_amount = db_aps.get_user_products_amount(user_id)
+    searches = await db_aps.get_user_existing_searches(user_id)
+    products_amount = await db_aps.get_user_products_amount(user_id)
 
     text = phrases.user_info.format(
         id=chat_info.id, full_name=chat_info.full_name,
@@ -1,12 +1,16 @@
-from asyncio import sleep
+from asyncio import gather, get_event_loop, Lock, Semaphore, sleep
+from collections import OrderedDict
 from concurrent.futures._base import TimeoutError
+from contextlib import asynccontextmanager
 import datetime
 from logging import getLogger
 import os
-from random import randint
+from random import choices
 from ssl import SSLError
+from time import monotonic
 import traceback
-from typing import Optional, List
+from typing import AsyncIterator, Callable, Dict, Iterable, Optional, List, Tuple
+from urllib.parse import urlsplit
 
 from aiogram import Bot
 import httpx
@@ -14,12 +18,43 @@ from proxy_randomizer.providers import RegisteredProviders
 from random_user_agent.user_agent import UserAgent
 from random_user_agent.params import SoftwareName, OperatingSystem
 
+import limiters
+
 
 utils_logger = getLogger('utils_logger')
 
 _log_bot = None
 _user_agents = None
-_registered_providers = None
+_proxies: List[str] = list()
+_proxy_stats: Dict[str, 'ProxyStats'] = dict()
+_proxies_update_lock = Lock()
+_http_clients: 'OrderedDict[str, PooledHttpClient]' = OrderedDict()
+
+PROXY_DEFAULT_LATENCY = 5
+PROXY_VALIDATION_URL = os.getenv('PROXY_VALIDATION_URL', 'https://www.google.com/generate_204')
+PROXY_VALIDATION_TIMEOUT = int(os.getenv('PROXY_VALIDATION_TIMEOUT', 10))
+PROXY_VALIDATION_CONCURRENCY = int(os.getenv('PROXY_VALIDATION_CONCURRENCY', 50))
+PROXY_COOLDOWN = int(os.getenv('PROXY_COOLDOWN', 60))
+PROXY_QUARANTINE_FAILURES = int(os.getenv('PROXY_QUARANTINE_FAILURES', 5))
+PROXY_QUARANTINE_TIME = int(os.getenv('PROXY_QUARANTINE_TIME', 3600))
+HTTP_CLIENTS_POOL_SIZE = int(os.getenv('HTTP_CLIENTS_POOL_SIZE', 50))
+HTTP_CLIENT_IDLE_TIMEOUT = int(os.getenv('HTTP_CLIENT_IDLE_TIMEOUT', 300))
+REQUEST_ERRORS = (
+    httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ReadError,
+    httpx.RemoteProtocolError, httpx.ProxyError, httpx.TimeoutException, TimeoutError,
+    ConnectionResetError, SSLError, httpx.WriteError, httpx.DecodingError, BrokenPipeError,
+)
+# Answers of the site about removed page, they are returned without retries
+GONE_STATUS_CODES = (httpx.codes.NOT_FOUND, httpx.codes.GONE)
+# Redirects with location, like httpx Response.has_redirect_location (is_redirect is any 3xx)
+REDIRECT_STATUS_CODES = (
+    httpx.codes.MOVED_PERMANENTLY, httpx.codes.FOUND, httpx.codes.SEE_OTHER,
+    httpx.codes.TEMPORARY_REDIRECT, httpx.codes.PERMANENT_REDIRECT,
+)
+# Site blocks proxy with them, such proxies are put on cool-down
+BLOCK_STATUS_CODES = (httpx.codes.FORBIDDEN, httpx.codes.TOO_MANY_REQUESTS)
+HTTP_CONNECTION_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5,
+                                      keepalive_expiry=HTTP_CLIENT_IDLE_TIMEOUT)
 
 
 async def handle_exception(logger_name: str, additional_text: Optional[str] = None):
@@ -96,58 +131,389 @@ def get_user_agent_header(limit: int = 300) -> dict:
     return agent_header
 
 
-def get_random_proxy() -> str:
-    """Get proxy from _registered_providers (exclude anonymity and country info)."""
-    if not _registered_providers:
-        parse_providers()
-    proxy = _registered_providers.get_random_proxy()  # type: ignore # func parse_providers()
-    # updates _registered_providers, so it have no chance to be NoneType
+class ProxyStats:
+    """Proxy health statistics used to choose proxies for requests."""
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.average_latency: Optional[float] = None
+        self.last_failure: Optional[float] = None
+        self.cooldown_until = 0.0
+
+    @property
+    def success_rate(self) -> float:
+        """Smoothed success rate, so new proxies are not ranked as dead ones."""
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def score(self) -> float:
+        """Proxy score, the bigger the better (healthy and fast proxies are preferred)."""
+        latency = self.average_latency
+        if latency is None:
+            latency = PROXY_DEFAULT_LATENCY
+        return self.success_rate ** 2 / max(latency, 0.1)
+
+    def is_available(self, now: float) -> bool:
+        """Check that proxy is not on cool-down or in quarantine."""
+        return now >= self.cooldown_until
+
+    def register_success(self, latency: float):
+        """Count successful request and update average latency."""
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        if self.average_latency is None:
+            self.average_latency = latency
+        else:
+            self.average_latency = 0.7 * self.average_latency + 0.3 * latency
+
+    def register_failure(self):
+        """Count failed request and put proxy on cool-down (quarantine if it fails in a row)."""
+        now = monotonic()
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_failure = now
+        if self.consecutive_failures >= PROXY_QUARANTINE_FAILURES:
+            cooldown = PROXY_QUARANTINE_TIME
+        else:
+            cooldown = min(PROXY_COOLDOWN * 2 ** (self.consecutive_failures - 1),
+                           PROXY_QUARANTINE_TIME)
+        self.cooldown_until = now + cooldown
+
+
+def get_best_proxy() -> str:
+    """Get proxy (exclude anonymity and country info) preferring healthy and fast ones.
+
+    Proxies on cool-down and in quarantine are skipped, if there are no other proxies
+    proxy with the nearest cool-down end is returned.
+    Proxy list should be already updated by update_proxies.
+    """
+    now = monotonic()
+    proxies_stats = [(proxy, get_proxy_stats(proxy)) for proxy in _proxies]
+    available_proxies = [
+        (proxy, stats) for proxy, stats in proxies_stats if stats.is_available(now)
+    ]
+    if not available_proxies:
+        utils_logger.warning('All proxies are on cool-down')
+        proxy, _ = min(proxies_stats, key=lambda proxy_stats: proxy_stats[1].cooldown_until)
+        return proxy
+
+    proxies, stats = zip(*available_proxies)
+    return choices(proxies, weights=[proxy_stats.score for proxy_stats in stats])[0]
+
+
+def get_proxy_stats(proxy: str) -> ProxyStats:
+    """Get proxy health statistics, create empty ones for unknown proxy."""
+    if proxy not in _proxy_stats:
+        _proxy_stats[proxy] = ProxyStats()
+    return _proxy_stats[proxy]
+
 
-    return proxy.get_proxy()
+def report_proxy_success(proxy: str, latency: float):
+    """Update proxy statistics with successful request."""
+    get_proxy_stats(proxy).register_success(latency)
 
 
-def parse_providers():
-    """Update registered providers and parse proxies of them."""
-    global _registered_providers
-    _registered_providers = RegisteredProviders()
-    _registered_providers.parse_providers()
+def report_proxy_failure(proxy: str):
+    """Update proxy statistics with failed request and put proxy on cool-down."""
+    proxy_stats = get_proxy_stats(proxy)
+    proxy_stats.register_failure()
+    if proxy_stats.consecutive_failures == PROXY_QUARANTINE_FAILURES:
+        utils_logger.debug(f'Proxy {proxy} is quarantined for {PROXY_QUARANTINE_TIME} sec')
+
+
+def report_bad_response(proxy: str, response: httpx.Response):
+    """Put proxy on cool-down if site blocked it or proxy redirected request on its own.
+
+    Other error answers (like 5xx) are just retried, they don't tell much about proxy.
+    """
+    utils_logger.debug(f'Got response status code {response.status_code} through {proxy}')
+    if response.status_code in BLOCK_STATUS_CODES or response.is_redirect:
+        report_proxy_failure(proxy)
+
+
+def parse_providers() -> List[str]:
+    """Parse proxies of registered providers.
+
+    Providers are scraped synchronously, so run it in executor.
+    """
+    registered_providers = RegisteredProviders()
+    registered_providers.parse_providers()
+    return list({proxy.get_proxy() for proxy in registered_providers.proxies})
+
+
+async def update_proxies(only_if_empty: bool = False):
+    """Parse proxies without blocking the loop, validate them and swap proxy list.
+
+    Statistics of proxies remaining in the list are kept.
+    """
+    global _proxies
+    async with _proxies_update_lock:
+        if only_if_empty and _proxies:
+            return
+        loop = get_event_loop()
+        proxies = await loop.run_in_executor(None, parse_providers)
+        if not proxies:
+            utils_logger.error('Got empty proxy list from providers')
+            return
+
+        alive_proxies = await validate_proxies(proxies)
+        if alive_proxies:
+            proxies = alive_proxies
+        else:
+            utils_logger.warning('None of proxies passed validation, use them unvalidated')
+
+        for proxy in set(_proxy_stats) - set(proxies):
+            del _proxy_stats[proxy]
+        _proxies = proxies
+    utils_logger.debug(f'Proxy list updated, got {len(proxies)} proxies')
+
+
+async def validate_proxies(proxies: List[str],
+                           concurrency: int = PROXY_VALIDATION_CONCURRENCY) -> List[str]:
+    """Check proxies concurrently and return alive ones."""
+    semaphore = Semaphore(concurrency)
+
+    async def check_proxy(proxy: str) -> bool:
+        async with semaphore:
+            return await is_proxy_alive(proxy)
+
+    checks = await gather(*[check_proxy(proxy) for proxy in proxies])
+    return [proxy for proxy, is_alive in zip(proxies, checks) if is_alive]
+
+
+async def is_proxy_alive(proxy: str) -> bool:
+    """Check that proxy is able to make https request."""
+    try:
+        async with httpx.AsyncClient(proxies={'https://': f'http://{proxy}'},  # type: ignore
+                                     timeout=PROXY_VALIDATION_TIMEOUT,
+                                     verify=False) as client:
+            response = await client.get(PROXY_VALIDATION_URL)
+    except (httpx.HTTPError, TimeoutError, OSError):
+        return False
+    return response.status_code < 400
 
 
 async def run_proxi_updater():
     while True:
-        parse_providers()
+        await update_proxies()
         await sleep(300)
 
 
-async def make_get_request(url: str, headers: dict = None) -> Optional[httpx.Response]:
-    """Make async GET request with proxy."""
+class PooledHttpClient:
+    """Http client bound to one proxy with usage info for the clients pool."""
+
+    def __init__(self, proxy: str):
+        self.proxy = proxy
+        self.client = httpx.AsyncClient(proxies={'https://': f'http://{proxy}'},  # type: ignore
+                                        limits=HTTP_CONNECTION_LIMITS,
+                                        timeout=15,
+                                        verify=False)
+        self.last_used = monotonic()
+        self.requests_in_progress = 0
+
+    def is_idle(self, idle_timeout: float = 0) -> bool:
+        """Check that client has no requests in progress for idle_timeout seconds."""
+        if self.requests_in_progress:
+            return False
+        return monotonic() - self.last_used >= idle_timeout
+
+
+@asynccontextmanager
+async def get_pooled_http_client(proxy: str) -> AsyncIterator[httpx.AsyncClient]:
+    """Get http client for proxy from the clients pool, create it if there is no such one.
+
+    Client stays in the pool after usage, so next requests through the same proxy
+    reuse its keep-alive connections instead of making new handshakes.
+    """
+    pooled_client = _http_clients.pop(proxy, None)
+    if not pooled_client:
+        pooled_client = PooledHttpClient(proxy)
+        utils_logger.debug(f'Created new http client for proxy {proxy}')
+    _http_clients[proxy] = pooled_client  # move client to the end of LRU order
+    # Client is marked busy before eviction, so that it isn't closed right before usage
+    pooled_client.requests_in_progress += 1
+    pooled_client.last_used = monotonic()
+    try:
+        await evict_http_clients()
+        yield pooled_client.client
+    finally:
+        pooled_client.requests_in_progress -= 1
+        pooled_client.last_used = monotonic()
+
+
+async def evict_http_clients():
+    """Close idle clients and least recently used clients over pool size limit."""
+    pool_size = len(_http_clients)
+    for proxy, pooled_client in list(_http_clients.items()):
+        is_over_limit = pool_size > HTTP_CLIENTS_POOL_SIZE
+        if not pooled_client.is_idle(0 if is_over_limit else HTTP_CLIENT_IDLE_TIMEOUT):
+            continue
+        await close_http_client(proxy)
+        pool_size -= 1
+
+
+async def close_http_client(proxy: str):
+    """Remove proxy client from the clients pool and close its connections."""
+    pooled_client = _http_clients.get(proxy)
+    if not pooled_client or not pooled_client.is_idle():
+        return
+    del _http_clients[proxy]
+    await pooled_client.client.aclose()
+    utils_logger.debug(f'Closed http client for proxy {proxy}')
+
+
+async def make_get_request(
+        url: str, headers: dict = None, budget: str = 'search', attempts: int = 100,
+        is_site_redirect: Callable[[str, str], bool] = None,
+) -> Optional[httpx.Response]:
+    """Make async GET request with proxy.
+
+    Every attempt waits for a slot of url host request budget ('search' or 'product').
+    Answers of the site itself (see is_site_answer) are returned, so check status code
+    of response, None is returned if all attempts failed.
+    """
     if not headers:
         headers = dict()
-    for _ in range(100):
-        await sleep(randint(3, 10))
-        agent_header = get_user_agent_header()
-        headers.update(agent_header)
-        proxies = {'https://': f'http://{get_random_proxy()}'}
-        async with httpx.AsyncClient(headers=headers,
-                                     proxies=proxies,  # type: ignore
-                                     timeout=15,
-                                     verify=False) as client:
-            try:
-                utils_logger.debug(f'GET request for url: {url}')
-                response = await client.get(url, allow_redirects=False)
-            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadTimeout,
-                    httpx.ReadError, httpx.RemoteProtocolError, httpx.ProxyError,
-                    httpx.TimeoutException, TimeoutError, ConnectionResetError,
-                    SSLError, httpx.WriteError, httpx.DecodingError,
-                    BrokenPipeError) as e:
-                utils_logger.debug(f'Got exception while GET request: {e}')
+    for _ in range(attempts):
+        request_headers = dict(headers, **get_user_agent_header())
+        if not _proxies:
+            await update_proxies(only_if_empty=True)
+            if not _proxies:
+                await sleep(PROXY_COOLDOWN)
                 continue
-            try:
-                response.raise_for_status()
-            except httpx.HTTPStatusError as e:
-                utils_logger.debug(f'Got exception in response status check: {e}')
+        async with limiters.request_budget(url, budget):
+            proxy = get_best_proxy()
+            request_start = monotonic()
+            async with get_pooled_http_client(proxy) as client:
+                try:
+                    utils_logger.debug(f'GET request for url: {url}')
+                    response = await client.get(url, headers=request_headers,
+                                                follow_redirects=False)
+                except REQUEST_ERRORS as e:
+                    utils_logger.debug(f'Got exception while GET request: {e}')
+                    is_failed = True
+                else:
+                    is_failed = False
+        if is_failed:
+            report_proxy_failure(proxy)
+            await close_http_client(proxy)
+            continue
+        if not is_site_answer(url, response, is_site_redirect):
+            report_bad_response(proxy, response)
+            continue
+        report_proxy_success(proxy, monotonic() - request_start)
+        utils_logger.debug('Got right response')
+        return response
+    utils_logger.error(f'Made {attempts} requests, none of them ended well. Url: {url}')
+    return None
+
+
+async def find_response_markers(url: str, markers: Iterable[bytes],
+                                stop_marker: Optional[bytes] = None, headers: dict = None,
+                                budget: str = 'search', attempts: int = 100,
+                                ) -> Optional[Tuple[int, Optional[bytes]]]:
+    """Make GET request with proxy and search markers in response body while it's streamed.
+
+    Body is read by chunks without decoding to str, reading stops at the first found
+    marker or at stop_marker, after which markers are not expected.
+    Returns response status code and found marker (None if there is no marker),
+    None if all attempts failed. Only answers of the site itself (see is_site_answer)
+    are returned, body of redirects and gone pages isn't searched.
+    """
+    markers = list(markers)
+    if not headers:
+        headers = dict()
+    for _ in range(attempts):
+        request_headers = dict(headers, **get_user_agent_header())
+        if not _proxies:
+            await update_proxies(only_if_empty=True)
+            if not _proxies:
+                await sleep(PROXY_COOLDOWN)
                 continue
-            utils_logger.debug('Got right response')
-            return response
-    utils_logger.error(f'Made 100 requests, none of them ended well. Url: {url}')
+        async with limiters.request_budget(url, budget):
+            proxy = get_best_proxy()
+            request_start = monotonic()
+            async with get_pooled_http_client(proxy) as client:
+                try:
+                    utils_logger.debug(f'Streamed GET request for url: {url}')
+                    async with client.stream('GET', url, headers=request_headers,
+                                             follow_redirects=False) as response:
+                        found_marker = None
+                        if response.is_success:
+                            found_marker = await find_markers(response, markers, stop_marker)
+                except REQUEST_ERRORS as e:
+                    utils_logger.debug(f'Got exception while streamed GET request: {e}')
+                    is_failed = True
+                else:
+                    is_failed = False
+        if is_failed:
+            report_proxy_failure(proxy)
+            await close_http_client(proxy)
+            continue
+        if not is_site_answer(url, response):
+            report_bad_response(proxy, response)
+            continue
+        report_proxy_success(proxy, monotonic() - request_start)
+        return response.status_code, found_marker
+    utils_logger.error(f'Made {attempts} streamed requests, none of them ended well. Url: {url}')
+    return None
+
+
+def is_site_answer(url: str, response: httpx.Response,
+                   is_site_redirect: Callable[[str, str], bool] = None) -> bool:
+    """Check that response is final answer of url site, which other proxies would get too.
+
+    These are success, not modified (conditional request answer), gone page and
+    redirect accepted by is_site_redirect(url, location), by default redirect
+    to another page of the site. Other redirects may be made by proxies.
+    """
+    if response.is_success or response.status_code == httpx.codes.NOT_MODIFIED:
+        return True
+    if response.status_code in GONE_STATUS_CODES:
+        return True
+    is_site_redirect = is_site_redirect or is_redirect_to_other_page
+    return response.has_redirect_location and is_site_redirect(
+        url, str(response.url.join(response.headers['location'])))
+
+
+def is_redirect_to_other_page(url: str, location: str) -> bool:
+    """Check that location is another page (not the same one) of url site."""
+    if not is_same_site(url, location):
+        return False
+    page_name = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+    return urlsplit(location).path.rstrip('/').rsplit('/', 1)[-1] != page_name
+
+
+def is_same_site(url: str, location: str) -> bool:
+    """Check that location is on url site or its subdomain."""
+    site = '.'.join((urlsplit(url).hostname or '').split('.')[-2:])
+    location_host = urlsplit(location).hostname or ''
+    return location_host == site or location_host.endswith(f'.{site}')
+
+
+async def find_markers(response: httpx.Response, markers: List[bytes],
+                       stop_marker: Optional[bytes] = None) -> Optional[bytes]:
+    """Read streamed response until one of markers or stop_marker is found.
+
+    Tail of previous chunk is kept, so markers split between chunks are found too.
+    """
+    tail_size = max(len(marker) for marker in markers + [stop_marker or b'']) - 1
+    tail = b''
+    read_size = 0
+    async for chunk in response.aiter_bytes():
+        read_size += len(chunk)
+        body_part = tail + chunk
+        stop_index = body_part.find(stop_marker) if stop_marker else -1
+        for marker in markers:
+            marker_index = body_part.find(marker)
+            if marker_index != -1 and (stop_index == -1 or marker_index < stop_index):
+                utils_logger.debug(f'Found marker {marker!r} in {read_size} bytes')
+                return marker
+        if stop_index != -1:
+            utils_logger.debug(f'Found stop marker in {read_size} bytes')
+            return None
+        tail = body_part[-tail_size:] if tail_size else b''
     return None
@@ -0,0 +1,74 @@
+"""Parser workers registry.
+
+Every parser process (bot in full mode or start_worker.py) sends heartbeats
+into db. Searches are distributed over live workers with rendezvous hashing,
+so when worker dies or joins, only its share of searches moves between workers.
+"""
+from asyncio import sleep
+from hashlib import md5
+from logging import getLogger
+import os
+import socket
+from typing import Awaitable, Callable, List
+
+import db_aps
+
+
+workers_logger = getLogger('workers_logger')
+
+WORKER_ID = os.getenv('WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}'
+WORKER_HEARTBEAT_INTERVAL = int(os.getenv('WORKER_HEARTBEAT_INTERVAL', 10))
+WORKER_TIMEOUT = int(os.getenv('WORKER_TIMEOUT', 30))
+
+_live_workers: List[str] = [WORKER_ID]
+
+
+def owns_search(search_url: str) -> bool:
+    """Check that search belongs to this worker."""
+    return get_search_owner(search_url) == WORKER_ID
+
+
+def get_search_owner(search_url: str) -> str:
+    """Get id of live worker with the highest rendezvous weight for search."""
+    return max(_live_workers, key=lambda worker_id: _get_weight(worker_id, search_url))
+
+
+def _get_weight(worker_id: str, search_url: str) -> int:
+    # Builtin hash is randomized per process, so workers would disagree on it
+    digest = md5(f'{worker_id}|{search_url}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+async def update_live_workers() -> bool:
+    """Send heartbeat and update live workers. Returns True if workers changed."""
+    global _live_workers
+    live_workers = await db_aps.register_worker_heartbeat(WORKER_ID, WORKER_TIMEOUT)
+    live_workers = sorted(set(live_workers) | {WORKER_ID})
+    if live_workers == _live_workers:
+        return False
+    _live_workers = live_workers
+    workers_logger.debug(f'Live workers changed: {live_workers}')
+    return True
+
+
+async def run_heartbeat(on_workers_change: Callable[[], Awaitable]):
+    """Send heartbeats and call on_workers_change when workers join or die.
+
+    Collector lease held by worker is prolonged with heartbeats.
+    """
+    while True:
+        await sleep(WORKER_HEARTBEAT_INTERVAL)
+        try:
+            await db_aps.prolong_lease(
+                db_aps.COLLECTOR_LEASE, WORKER_ID, db_aps.COLLECTOR_LEASE_TTL)
+            if await update_live_workers():
+                await on_workers_change()
+        except Exception:
+            workers_logger.exception('Worker heartbeat failed')
+
+
+async def leave():
+    """Remove worker from live ones and release its lease, so that others take over at once."""
+    await db_aps.remove_worker(WORKER_ID)
+    await db_aps.release_lease(db_aps.COLLECTOR_LEASE, WORKER_ID)
+    workers_logger.debug(f'Worker {WORKER_ID} left')
@@ -0,0 +1,116 @@
+"""Diff of search page products with stored ones: sequential HGETALL against pipelined HGET.
+
+Redis is replaced with a local RESP stub, which delays every reply by RTT,
+so that the number of round trips is what is measured.
+
+Run from repository root: python benchmarks/find_new_products.py [products] [rtt_ms]
+"""
+import asyncio
+import os
+import sys
+from time import perf_counter
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'Bot'))
+
+import db_aps  # noqa: E402
+
+STUB_HOST = '127.0.0.1'
+STORED_PRICE = b'1000'
+USER_ID = '1'
+
+
+async def read_command(reader: asyncio.StreamReader) -> list:
+    """Read one RESP command, sent by client as array of bulk strings."""
+    header = await reader.readline()
+    if not header:
+        return []
+    command = []
+    for _ in range(int(header[1:])):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+def encode_reply(command: list) -> bytes:
+    name = command[0].upper()
+    if name == b'HGET':
+        return b'$%d\r\n%s\r\n' % (len(STORED_PRICE), STORED_PRICE)
+    if name == b'HGETALL':
+        return b'*2\r\n$5\r\nprice\r\n$%d\r\n%s\r\n' % (len(STORED_PRICE), STORED_PRICE)
+    return b'+OK\r\n'
+
+
+class RedisStub:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.round_trips = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            command = await read_command(reader)
+            if not command:
+                break
+            replies = [encode_reply(command)]
+            while reader._buffer:  # Pipelined commands, which already came with this one
+                replies.append(encode_reply(await read_command(reader)))
+            self.round_trips += 1
+            await asyncio.sleep(self.rtt)
+            writer.write(b''.join(replies))
+            await writer.drain()
+        writer.close()
+
+
+async def find_new_and_updated_products_sequential(product_infos: list, user_id):
+    """Diff as it was done before pipelining, one HGETALL per product."""
+    db = await db_aps.get_database_connection()
+    new_products = []
+    updated_products = []
+    for product in product_infos:
+        product_key = f'{db_aps.DB_PRODUCT_PREFIX}{user_id}:{product["product_id"]}'
+        db_product = await db.hgetall(product_key)
+        if not db_product:
+            new_products.append(product)
+            continue
+        if product['price'] != db_product[b'price'].decode('utf-8'):
+            updated_products.append(product)
+    return new_products, updated_products
+
+
+async def run(products_count: int, rtt: float):
+    stub = RedisStub(rtt)
+    server = await asyncio.start_server(stub.handle, STUB_HOST, 0)
+    os.environ['DB_HOST'] = STUB_HOST
+    os.environ['DB_PORT'] = str(server.sockets[0].getsockname()[1])
+    os.environ.pop('DB_PASSWORD', None)
+    await (await db_aps.get_database_connection()).ping()
+
+    product_infos = [
+        {'product_id': str(product_id), 'price': STORED_PRICE.decode()}
+        for product_id in range(products_count)
+    ]
+    print(f'{products_count} products, {rtt * 1000:.0f} ms round trip time')
+    for name, find_products in [
+        ('sequential HGETALL', find_new_and_updated_products_sequential),
+        ('pipelined HGET price', db_aps.find_new_and_updated_products),
+    ]:
+        stub.round_trips = 0
+        start = perf_counter()
+        await find_products(product_infos, USER_ID)
+        print(f'  {name}: {stub.round_trips} round trips, {perf_counter() - start:.3f} s')
+
+    db = await db_aps.get_database_connection()
+    db.close()
+    await db.wait_closed()
+    server.close()
+    await server.wait_closed()
+
+
+def main():
+    products_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rtt = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    asyncio.get_event_loop().run_until_complete(run(products_count, rtt))
+
+
+if __name__ == '__main__':
+    main()
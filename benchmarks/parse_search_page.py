@@ -0,0 +1,44 @@
+"""Search page parsers throughput on saved pages.
+
+Run from repository root: python benchmarks/parse_search_page.py [page.html ...]
+Test pages without and with embedded state are used by default,
+'json' parser falls back to lxml on the first one.
+"""
+import os
+import sys
+from time import perf_counter
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'Bot'))
+
+import avito_parser  # noqa: E402
+import page_parser  # noqa: E402
+
+PARSERS = {
+    'bs4': avito_parser.parse_search_page_bs4,
+    'lxml': page_parser.parse_search_page,
+    'json': page_parser.parse_search_page_json,
+}
+ROUNDS = 50
+
+
+def main():
+    page_paths = sys.argv[1:] or [
+        os.path.join(ROOT_DIR, 'tests', 'data', page_name)
+        for page_name in ('search_page.html', 'search_page_state.html')
+    ]
+    for page_path in page_paths:
+        with open(page_path, 'rb') as page_file:
+            page = page_file.read()
+        print(f'{os.path.basename(page_path)}: {len(page) // 1024} KiB, '
+              f'{len(page_parser.parse_search_page(page))} products')
+        for parser_name, parse in PARSERS.items():
+            start = perf_counter()
+            for _ in range(ROUNDS):
+                parse(page)
+            page_time = (perf_counter() - start) / ROUNDS
+            print(f'  {parser_name}: {page_time * 1000:.2f} ms/page, {1 / page_time:.0f} pages/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Bot modules are run as scripts from Bot directory and import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'Bot'))
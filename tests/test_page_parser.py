@@ -0,0 +1,81 @@
+"""Search page parsers against golden products.
+
+Pages in tests/data are synthetic, they aren't saved from Avito: listings
+(ids 1900000000 + i * 7919, templated titles and prices) are generated
+in the markup and embedded state schema which the parsers target.
+"""
+import json
+import os
+
+import pytest
+
+import avito_parser
+import db_aps
+import page_parser
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def read_data(file_name: str) -> bytes:
+    with open(os.path.join(DATA_DIR, file_name), 'rb') as data_file:
+        return data_file.read()
+
+
+def test_lxml_parser_matches_golden_products():
+    golden_products = json.loads(read_data('search_page_products.json'))
+    assert page_parser.parse_search_page(read_data('search_page.html')) == golden_products
+
+
+def test_bs4_parser_matches_golden_products():
+    golden_products = json.loads(read_data('search_page_products.json'))
+    assert avito_parser.parse_search_page_bs4(read_data('search_page.html')) == golden_products
+
+
+def test_lxml_parser_skips_products_without_id_or_link():
+    page = read_data('search_page.html')
+    page = page.replace(b'data-item-id="1900000000"', b'', 1)
+    page = page.replace(b'href="/moskva/avtomobili/bmw_x5_2011_1900007919" title', b'title', 1)
+
+    product_ids = [product['product_id'] for product in page_parser.parse_search_page(page)]
+
+    assert '' not in product_ids
+    assert '1900007919' not in product_ids
+    assert len(product_ids) == 20
+
+
+@pytest.mark.parametrize('page_name', ['search_page_state.html', 'search_page_state_encoded.html'])
+def test_json_parser_matches_golden_state_products(page_name):
+    golden_products = json.loads(read_data('search_page_state_products.json'))
+    assert page_parser.parse_search_page_state(read_data(page_name)) == golden_products
+    assert page_parser.parse_search_page_json(read_data(page_name)) == golden_products
+
+
+def test_state_products_differ_from_css_products_only_in_format():
+    state_products = json.loads(read_data('search_page_state_products.json'))
+    css_products = json.loads(read_data('search_page_products.json'))
+
+    assert len(state_products) == len(css_products)
+    for state_product, css_product in zip(state_products, css_products):
+        for key in ('product_id', 'title', 'product_url', 'img_url'):
+            assert state_product[key] == css_product[key]
+        assert (db_aps.normalize_price(state_product['price'])
+                == db_aps.normalize_price(css_product['price']))
+    # Publication date is formatted from item timestamp, markup has tooltip text
+    assert state_products[0]['pub_date'] == '13.09.2020 15:26'
+    assert css_products[0]['pub_date'] == '12 октября 16:18'
+
+
+def test_json_parser_falls_back_to_css_when_required_field_is_missing():
+    page = read_data('search_page_state.html').replace(b'"string": ', b'"text": ', 1)
+
+    with pytest.raises(KeyError):
+        page_parser.parse_search_page_state(page)
+    assert page_parser.parse_search_page_json(page) == json.loads(
+        read_data('search_page_products.json'))
+
+
+def test_json_parser_falls_back_to_css_without_state():
+    assert page_parser.get_initial_state(read_data('search_page.html')) is None
+    assert page_parser.parse_search_page_json(read_data('search_page.html')) == json.loads(
+        read_data('search_page_products.json'))